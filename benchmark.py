@@ -0,0 +1,449 @@
+# benchmark.py
+# End-to-end benchmark against a local fake komiku.org. The fake server serves
+# synthetic series pages, chapter HTML and page images with configurable
+# latency, bandwidth and error rate; the harness drives get_manga_info,
+# download_chapter, download_chapter_big (or the asyncio pipeline, with
+# PAGE_PIPELINE=asyncio) and create_pdf and prints the results as JSON so runs
+# can be compared.
+#
+# The startup scenario runs main.py as a real bot process against a fake Bot
+# API, with a downloads folder full of stale chapters left behind, and times
+# how long it takes to start polling and to answer its first update.
+#
+#   python benchmark.py --chapters 5 --pages 20 --latency-ms 80 --output before.json
+import argparse
+import json
+import os
+import random
+import shutil
+import resource
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from io import BytesIO
+
+class FakeKomiku(ThreadingHTTPServer):
+    """Serves /manga/<slug>/, /<slug>-chapter-<n>/ and /img/<slug>/<n>/<page>.jpg"""
+
+    daemon_threads = True
+
+    def __init__(self, chapters, pages, page_size, latency, bandwidth, error_rate, seed=0):
+        super().__init__(("127.0.0.1", 0), FakeKomikuHandler)
+        self.chapters = chapters
+        self.pages = pages
+        self.page_size = page_size
+        self.latency = latency
+        self.bandwidth = bandwidth  # bytes per second per response, 0 = unlimited
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.images = {}
+        self.stats = {"requests": 0, "errors_injected": 0, "bytes_sent": 0}
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def count(self, key, amount=1):
+        with self.lock:
+            self.stats[key] += amount
+
+    def should_fail(self):
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    def image(self, variant):
+        """A synthetic webtoon page: panels with gutters, a little noise so JPEG sizes are realistic"""
+        with self.lock:
+            data = self.images.get(variant)
+        if data is not None:
+            return data
+        from PIL import Image, ImageDraw
+        width, height = self.page_size
+        rng = random.Random(variant)
+        img = Image.new("RGB", (width, height), "white")
+        draw = ImageDraw.Draw(img)
+        top = 40
+        while top < height - 100:
+            bottom = min(height - 40, top + rng.randint(300, 700))
+            colour = tuple(rng.randint(40, 220) for _ in range(3))
+            draw.rectangle((30, top, width - 30, bottom), fill=colour)
+            for _ in range(60):
+                x, y = rng.randint(30, width - 60), rng.randint(top, max(top, bottom - 30))
+                draw.ellipse((x, y, x + 30, y + 30), fill=tuple(rng.randint(0, 255) for _ in range(3)))
+            top = bottom + rng.randint(60, 160)
+        buffer = BytesIO()
+        img.save(buffer, "JPEG", quality=90)
+        data = buffer.getvalue()
+        with self.lock:
+            self.images[variant] = data
+        return data
+
+class FakeKomikuHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        server = self.server
+        server.count("requests")
+        if server.latency:
+            time.sleep(server.latency)
+        if server.should_fail():
+            server.count("errors_injected")
+            return self.respond(503, b"busy", "text/plain")
+
+        path = self.path.split("?")[0]
+        parts = [part for part in path.split("/") if part]
+        if len(parts) == 2 and parts[0] == "manga":
+            return self.respond(200, self.series_page(parts[1]).encode(), "text/html")
+        if len(parts) == 1 and "-chapter-" in parts[0]:
+            slug, number = parts[0].rsplit("-chapter-", 1)
+            return self.respond(200, self.chapter_page(slug, number).encode(), "text/html")
+        if len(parts) == 4 and parts[0] == "img":
+            # Pages repeat every 8 images so generating them doesn't dominate the run
+            page = int(parts[3].split(".")[0])
+            return self.respond(200, server.image(page % 8), "image/jpeg")
+        self.respond(404, b"not found", "text/plain")
+
+    def series_page(self, slug):
+        links = "".join(
+            f'<tr><td class="judulseries"><a href="/{slug}-chapter-{n}/">Chapter {n}</a></td></tr>'
+            for n in range(self.server.chapters, 0, -1)
+        )
+        return (
+            f'<html><body><h1>Komik {slug.title()}</h1>'
+            f'<table class="inftable"><tr><td>Judul Komik</td><td>{slug.title()}</td></tr>'
+            f'<tr><td>Pengarang</td><td>Bench</td></tr></table>'
+            f'<table id="Daftar_Chapter">{links}</table></body></html>'
+        )
+
+    def chapter_page(self, slug, number):
+        images = "".join(
+            f'<img src="/img/{slug}/{number}/{i}.jpg" alt="page {i}">'
+            for i in range(1, self.server.pages + 1)
+        )
+        return (
+            '<html><body><img src="/asset/img/logo.png">'
+            f'<div id="Baca_Komik">{images}</div></body></html>'
+        )
+
+    def respond(self, status, body, content_type):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        bandwidth = self.server.bandwidth
+        if not bandwidth:
+            self.wfile.write(body)
+        else:
+            # Throttle in 16 KB slices to emulate a slow link
+            chunk = 16 * 1024
+            for start in range(0, len(body), chunk):
+                self.wfile.write(body[start:start + chunk])
+                time.sleep(min(chunk, len(body) - start) / bandwidth)
+        self.server.count("bytes_sent", len(body))
+
+class FakeTelegram(ThreadingHTTPServer):
+    """Bot API stand-in: the first getUpdates returns one /start message, later ones return nothing"""
+
+    daemon_threads = True
+
+    def __init__(self):
+        super().__init__(("127.0.0.1", 0), FakeTelegramHandler)
+        self.calls = []  # (seconds on the monotonic clock, method)
+        self.lock = threading.Lock()
+        self.delivered = False
+
+    @property
+    def base_url(self):
+        return f"http://127.0.0.1:{self.server_port}"
+
+    def first(self, method):
+        with self.lock:
+            return next((at for at, name in self.calls if name == method), None)
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        method = self.path.split("?")[0].rstrip("/").rsplit("/", 1)[-1]
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            self.rfile.read(length)
+        with self.server.lock:
+            self.server.calls.append((time.monotonic(), method))
+            deliver = method == "getUpdates" and not self.server.delivered
+            if deliver:
+                self.server.delivered = True
+        chat = {"id": 1, "type": "private"}
+        if method == "getUpdates":
+            if not deliver:
+                # A short long-poll, so the bot doesn't spin
+                time.sleep(0.2)
+            message = {"message_id": 1, "date": int(time.time()), "chat": chat, "text": "/start",
+                       "entities": [{"type": "bot_command", "offset": 0, "length": 6}]}
+            result = [{"update_id": 1, "message": message}] if deliver else []
+        elif method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        elif method.startswith("send"):
+            result = {"message_id": len(self.server.calls), "date": int(time.time()), "chat": chat}
+        else:
+            result = True
+        body = json.dumps({"ok": True, "result": result}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    do_GET = do_POST
+
+def percentiles(values):
+    if not values:
+        return {}
+    ordered = sorted(values)
+
+    def pick(q):
+        return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+    return {
+        "p50": round(pick(0.50), 2),
+        "p90": round(pick(0.90), 2),
+        "p99": round(pick(0.99), 2),
+        "max": round(ordered[-1], 2),
+        "mean": round(statistics.fmean(ordered), 2),
+    }
+
+def cpu_seconds():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+def peak_rss_mb():
+    # ru_maxrss is in KiB on Linux (bytes on macOS); children only counts worker
+    # processes that have already exited
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024
+    return {"self": round(own / unit, 1), "children": round(children / unit, 1)}
+
+def measure(name, server, func):
+    """Run func() -> (items, item_latencies_ms, extra) and wrap it in the common timing fields"""
+    requests_before = dict(server.stats)
+    cpu_before = cpu_seconds()
+    started = time.perf_counter()
+    pages, latencies, extra = func()
+    wall = time.perf_counter() - started
+    result = {
+        "scenario": name,
+        "wall_seconds": round(wall, 3),
+        "cpu_seconds": round(cpu_seconds() - cpu_before, 3),
+        "pages": pages,
+        "pages_per_sec": round(pages / wall, 2) if wall else None,
+        "latency_ms": percentiles(latencies),
+        "server": {key: server.stats[key] - requests_before[key] for key in server.stats},
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    result.update(extra)
+    return result
+
+def stage_totals():
+    """Time per pipeline stage across the whole run, from the bot's own span metrics"""
+    import metrics
+    return {
+        stage: {"count": count, "seconds": round(total, 3), "mean_ms": round(total / count * 1000, 2)}
+        for (stage,), (count, total) in sorted(metrics.stage_seconds.totals().items())
+        if count
+    }
+
+def run_metadata(main, manga_url, rounds):
+    latencies = []
+    for _ in range(rounds):
+        # Cold lookups: drop the per-slug cache so every round fetches and parses the page
+        main.metadata._cache.clear()
+        started = time.perf_counter()
+        base_url, _, _, chapters = main.get_manga_info(manga_url)
+        latencies.append((time.perf_counter() - started) * 1000)
+        if not base_url:
+            raise RuntimeError("get_manga_info failed against the fake server")
+    return 0, latencies, {"rounds": rounds, "chapters_found": len(chapters)}
+
+def run_chapters(main, chapters, output_dir, big):
+    import downloader
+    download = downloader.download_chapter_big if big else downloader.download_chapter
+    if downloader.PAGE_PIPELINE == "asyncio":
+        import functools
+        import pipeline
+        download = functools.partial(pipeline.download_chapter_pipeline, big=big)
+    chapter_ms, pdf_ms = [], []
+    pages = failed = 0
+    for number, url in chapters:
+        started = time.perf_counter()
+        images = download(url, number, output_dir)
+        chapter_ms.append((time.perf_counter() - started) * 1000)
+        if not images:
+            failed += 1
+            continue
+        pages += len(images)
+        started = time.perf_counter()
+        downloader.create_pdf(images, os.path.join(output_dir, f"chapter-{number}.pdf"))
+        pdf_ms.append((time.perf_counter() - started) * 1000)
+    return pages, chapter_ms, {"chapters": len(chapters), "chapters_failed": failed, "pdf_build_ms": percentiles(pdf_ms)}
+
+def make_stale_downloads(root, chapters, pages, page_bytes):
+    """A downloads folder like the one a crashed bot leaves: unfinished chapters and a job folder"""
+    filler = os.urandom(page_bytes)
+    for number in range(1, chapters + 1):
+        folder = os.path.join(root, "downloads", "stale", str(number))
+        os.makedirs(folder)
+        for page in range(1, pages + 1):
+            with open(os.path.join(folder, f"{page:03}.jpg"), "wb") as f:
+                f.write(filler)
+    job = os.path.join(root, "downloads", "jobs", "1")
+    os.makedirs(job)
+    with open(os.path.join(job, "stale chapter 1.pdf"), "wb") as f:
+        f.write(filler)
+
+def run_startup(args):
+    """Start main.py as a polling bot and time its first getUpdates and its reply to /start"""
+    root = tempfile.mkdtemp(prefix="komiku-startup-")
+    make_stale_downloads(root, args.stale_chapters, args.pages, args.stale_page_kb * 1024)
+    telegram = FakeTelegram()
+    threading.Thread(target=telegram.serve_forever, daemon=True).start()
+    env = dict(
+        os.environ,
+        TELEGRAM_API_URL=telegram.base_url,
+        PORT="0",
+        STATE_STORE="memory",
+        PAGE_CACHE_DIR=os.path.join(root, "cache", "pages"),
+        RESULT_CACHE_PATH=os.path.join(root, "cache", "results.db"),
+    )
+    env.pop("WEBHOOK_URL", None)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "main.py")
+    trash = os.path.join(root, "downloads", ".trash")
+    with open(os.path.join(root, "bot.log"), "w") as log:
+        started = time.monotonic()
+        bot = subprocess.Popen([sys.executable, script], cwd=root, env=env, stdout=log, stderr=subprocess.STDOUT)
+        try:
+            deadline = started + args.startup_timeout
+            while telegram.first("sendMessage") is None and time.monotonic() < deadline and bot.poll() is None:
+                time.sleep(0.01)
+            replied = telegram.first("sendMessage")
+            trash_left = os.path.exists(trash)
+            while os.path.exists(trash) and time.monotonic() < deadline:
+                time.sleep(0.05)
+            cleaned = time.monotonic()
+        finally:
+            bot.terminate()
+            bot.wait()
+            telegram.shutdown()
+    if replied is None:
+        with open(os.path.join(root, "bot.log")) as f:
+            print(f.read(), file=sys.stderr)
+        raise RuntimeError("the bot never answered /start")
+    polled = telegram.first("getUpdates")
+    result = {
+        "scenario": "startup",
+        "stale_chapters": args.stale_chapters,
+        "stale_mb": round(args.stale_chapters * args.pages * args.stale_page_kb / 1024, 1),
+        "ready_seconds": round(polled - started, 3),
+        "first_update_seconds": round(replied - started, 3),
+        "stale_cleanup_seconds": round(cleaned - started, 3) if not os.path.exists(trash) else None,
+        "cleanup_after_first_update": trash_left,
+    }
+    shutil.rmtree(root, ignore_errors=True)
+    return result
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the download pipeline against a local fake komiku.org")
+    parser.add_argument("--chapters", type=int, default=3, help="chapters in the synthetic series")
+    parser.add_argument("--pages", type=int, default=12, help="pages per chapter")
+    parser.add_argument("--page-size", default="800x3000", help="synthetic page size WIDTHxHEIGHT")
+    parser.add_argument("--latency-ms", type=float, default=50, help="added latency per request")
+    parser.add_argument("--bandwidth-kbps", type=float, default=0, help="per-response bandwidth in KB/s (0 = unlimited)")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="fraction of requests answered with 503")
+    parser.add_argument("--metadata-rounds", type=int, default=5)
+    parser.add_argument("--scenarios", default="metadata,normal,big,startup", help="comma-separated subset of metadata,normal,big,startup")
+    parser.add_argument("--stale-chapters", type=int, default=200, help="leftover chapter folders the startup scenario starts with")
+    parser.add_argument("--stale-page-kb", type=int, default=64, help="size of each leftover page")
+    parser.add_argument("--startup-timeout", type=float, default=60)
+    parser.add_argument("--page-cache", action="store_true", help="keep the page cache enabled (off by default so every run downloads)")
+    parser.add_argument("--unthrottled", action="store_true", help="disable the upstream rate limiter")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory with the downloads and PDFs")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    width, height = (int(value) for value in args.page_size.lower().split("x"))
+    output_path = os.path.abspath(args.output) if args.output else None
+
+    # Everything the bot writes goes to a scratch directory; settings are read at import time
+    workdir = tempfile.mkdtemp(prefix="komiku-bench-")
+    os.chdir(workdir)
+    os.environ.setdefault("BOT_TOKEN", "0:benchmark")
+    os.environ["PAGE_CACHE_DIR"] = os.path.join(workdir, "cache", "pages")
+    os.environ["RESULT_CACHE_PATH"] = os.path.join(workdir, "cache", "results.db")
+    if not args.page_cache:
+        os.environ["PAGE_CACHE_MAX_MB"] = "0"
+    if args.unthrottled:
+        os.environ["UPSTREAM_RATE"] = "0"
+        os.environ["HOST_RATE"] = "0"
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+    server = FakeKomiku(
+        args.chapters, args.pages, (width, height),
+        args.latency_ms / 1000, args.bandwidth_kbps * 1024, args.error_rate, args.seed,
+    )
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+
+    import_started = time.perf_counter()
+    import main as bot_main
+    import_seconds = time.perf_counter() - import_started
+
+    manga_url = f"{server.base_url}/manga/bench/"
+    _, _, _, chapters = bot_main.get_manga_info(manga_url)
+    output_dir = os.path.join(workdir, "downloads", "bench")
+
+    results = []
+    scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    for name in scenarios:
+        if name == "metadata":
+            results.append(measure(name, server, lambda: run_metadata(bot_main, manga_url, args.metadata_rounds)))
+        elif name in ("normal", "big"):
+            big = name == "big"
+            results.append(measure(name, server, lambda: run_chapters(bot_main, chapters, output_dir, big)))
+        elif name == "startup":
+            results.append(run_startup(args))
+        else:
+            raise SystemExit(f"unknown scenario: {name}")
+
+    report = {
+        "config": {key: value for key, value in vars(args).items() if key not in ("output", "keep")},
+        "import_seconds": round(import_seconds, 3),
+        "results": results,
+        "stages": stage_totals(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+    text = json.dumps(report, indent=2)
+    if output_path:
+        with open(output_path, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+    server.shutdown()
+    if args.keep:
+        print(f"Scratch directory kept: {workdir}", file=sys.stderr)
+    else:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
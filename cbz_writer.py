@@ -0,0 +1,117 @@
+# cbz_writer.py
+# CBZ output: a ZIP of the page images as downloaded (ZIP_STORED, so JPEG
+# bytes are copied in, never decoded or recompressed) plus a ComicInfo.xml
+# built from the series page. Pages are appended while chapters arrive, and
+# an archive that would go over the upload cap rolls over into numbered parts.
+import os
+import zipfile
+import xml.etree.ElementTree as ET
+
+def comic_info_xml(info, title=None, number=None, page_count=0):
+    """ComicInfo.xml (ComicRack schema) for one archive from metadata.get_series_info() details"""
+    root = ET.Element("ComicInfo")
+    fields = [
+        ("Title", title),
+        ("Series", info.get("title")),
+        ("Number", number),
+        ("Summary", info.get("summary")),
+        ("Writer", info.get("author")),
+        ("Genre", ", ".join(info.get("genres", []))),
+        ("Web", info.get("url")),
+        ("PageCount", page_count),
+        ("LanguageISO", "id"),
+    ]
+    for tag, value in fields:
+        if value not in (None, ""):
+            ET.SubElement(root, tag).text = str(value)
+    return ET.tostring(root, encoding="utf-8", xml_declaration=True)
+
+class CbzWriter:
+    """Append-only CBZ archive; ComicInfo.xml is written on close, when the page count is known"""
+
+    def __init__(self, output_path, info=None, title=None, number=None):
+        self.zip = zipfile.ZipFile(output_path, "w", compression=zipfile.ZIP_STORED)
+        self.info = info
+        self.title = title
+        self.number = number
+        self.pages = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+    def add_image(self, img_path):
+        self.pages += 1
+        ext = os.path.splitext(img_path)[1].lower() or ".jpg"
+        # ZipFile.write copies the file in chunks, so a page is never held in memory whole
+        self.zip.write(img_path, f"{self.pages:04}{ext}")
+
+    def size(self):
+        return self.zip.fp.tell()
+
+    def close(self):
+        if self.zip.fp is None:
+            return
+        if self.info is not None:
+            self.zip.writestr("ComicInfo.xml", comic_info_xml(self.info, self.title, self.number, self.pages))
+        self.zip.close()
+
+class CbzParts:
+    """CBZ output that starts a new archive before one would grow past max_bytes (0 = never split)
+
+    Parts are written as <name>.<n>.part and renamed on close, to <name>.cbz
+    when there is only one and to "<name> part <n>.cbz" otherwise.
+    """
+
+    def __init__(self, output_path, max_bytes=0, info=None, title=None, number=None):
+        self.output_path = output_path
+        self.max_bytes = max_bytes
+        self.info = info
+        self.title = title
+        self.number = number
+        self.paths = []
+        self.writer = None
+
+    def add_image(self, img_path):
+        size = os.path.getsize(img_path)
+        full = self.writer and self.max_bytes and self.writer.size() + size > self.max_bytes
+        if self.writer is None or (full and self.writer.pages):
+            self._next_part()
+        self.writer.add_image(img_path)
+
+    def add_images(self, images):
+        for img_path in images:
+            self.add_image(img_path)
+
+    def _next_part(self):
+        if self.writer:
+            self.writer.close()
+        path = f"{self.output_path}.{len(self.paths) + 1}.part"
+        self.paths.append(path)
+        self.writer = CbzWriter(path, self.info, self.title, self.number)
+
+    def close(self):
+        """Finish the archives; returns their final paths in order"""
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        stem = os.path.splitext(self.output_path)[0]
+        final = []
+        for part, path in enumerate(self.paths, start=1):
+            final_path = self.output_path if len(self.paths) == 1 else f"{stem} part {part}.cbz"
+            os.replace(path, final_path)
+            final.append(final_path)
+        self.paths = []
+        return final
+
+    def discard(self):
+        """Close and delete everything written so far (used on cancel)"""
+        if self.writer:
+            self.writer.close()
+            self.writer = None
+        for path in self.paths:
+            if os.path.exists(path):
+                os.remove(path)
+        self.paths = []
@@ -1,147 +1,333 @@
 # downloader.py
+import functools
 import os
-import requests
-from bs4 import BeautifulSoup
-from PIL import Image
-from io import BytesIO
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from requests import RequestException
+import http_client
+from pdf_writer import PdfWriter, is_passthrough_jpeg
+import extractor
+import imaging
+import metrics
+import page_cache
+from manifest import ChapterManifest
+from singleflight import chapter_flights, chapter_leases
+
+CHUNK_SIZE = 64 * 1024
+
+# Pages fetched in parallel for a single chapter
+PAGE_WORKERS = int(os.getenv("PAGE_WORKERS", "6"))
+# Pages fetched in parallel across every chapter and user of this process
+MAX_PAGE_FETCHES = int(os.getenv("MAX_PAGE_FETCHES", "16"))
+# Extra rounds over failed pages before a chapter is handed to the PDF builder
+PAGE_RETRY_PASSES = int(os.getenv("PAGE_RETRY_PASSES", "2"))
+
+# Chapters of one request downloaded ahead of the one being built and sent
+CHAPTER_WORKERS = int(os.getenv("CHAPTER_WORKERS", "2"))
+# threads (fetch_pages) or asyncio (pipeline.py, fetch and transform as overlapping stages)
+PAGE_PIPELINE = os.getenv("PAGE_PIPELINE", "threads")
+
+fetch_slots = threading.BoundedSemaphore(MAX_PAGE_FETCHES)
+
+def is_cancelled(chat_id, user_cancel):
+    return bool(user_cancel and chat_id and user_cancel.get(chat_id))
+
+class Pages(list):
+    """Page paths of a chapter in order; complete is False when pages were dropped after every retry"""
+
+    def __init__(self, paths=(), complete=False):
+        super().__init__(paths)
+        self.complete = complete
+
+def is_complete(images):
+    """True for a chapter download in which every page was saved"""
+    return bool(images) and getattr(images, "complete", False)
+
+def fetch_pages(img_urls, save_page, chat_id=None, user_cancel=None):
+    """Run save_page(index, url) for every page on a bounded pool; returns Pages in page order or None if cancelled
+
+    img_urls may be lazy (an extractor.PageStream): each page is submitted as
+    soon as its URL arrives.
+    """
+    urls = []
+
+    def numbered(indices=None):
+        if indices is not None:
+            yield from ((i, urls[i - 1]) for i in indices)
+            return
+        for i, img_url in enumerate(img_urls, start=1):
+            urls.append(img_url)
+            yield i, img_url
+
+    def worker(i, img_url):
+        if is_cancelled(chat_id, user_cancel):
+            return None
+        with fetch_slots:
+            # The flag may have flipped while waiting for a global slot
+            if is_cancelled(chat_id, user_cancel):
+                return None
+            try:
+                return save_page(i, img_url)
+            except Exception as e:
+                print(f"    [!] Gagal download {img_url}: {e}")
+                return None
+
+    results = {}
+
+    def run_pass(pages):
+        with ThreadPoolExecutor(max_workers=max(1, PAGE_WORKERS)) as pool:
+            futures = {}
+            for i, img_url in pages:
+                if is_cancelled(chat_id, user_cancel):
+                    break
+                futures[pool.submit(worker, i, img_url)] = i
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+                if is_cancelled(chat_id, user_cancel):
+                    pool.shutdown(wait=True, cancel_futures=True)
+                    return False
+        return not is_cancelled(chat_id, user_cancel)
+
+    pending = None  # the first pass walks img_urls itself
+    for attempt in range(PAGE_RETRY_PASSES + 1):
+        if attempt:
+            print(f"    [*] Mengulang {len(pending)} gambar yang gagal (percobaan {attempt})")
+            time.sleep(min(10, 2 ** attempt) + random.uniform(0, 1))
+        if not run_pass(numbered(pending)):
+            return None
+        pending = [i for i in range(1, len(urls) + 1) if results.get(i) is None]
+        if not pending:
+            break
+
+    if is_cancelled(chat_id, user_cancel):
+        return None
+    saved = [results[i] for i in range(1, len(urls) + 1) if results.get(i)]
+    return Pages(saved, complete=bool(urls) and len(saved) == len(urls))
+
+def resumable(save_page, chapter_folder, chapter_url):
+    """Wrap save_page(i, url, img_path) so pages finished by an earlier run are skipped and every outcome lands in the manifest"""
+    manifest = ChapterManifest(chapter_folder, chapter_url)
+
+    def save_or_skip(i, img_url):
+        img_path = os.path.join(chapter_folder, f"{i:03}.jpg")
+        if manifest.is_done(i, img_url, img_path):
+            return img_path
+        try:
+            save_page(i, img_url, img_path)
+        except Exception as e:
+            manifest.mark_failed(i, img_url, e)
+            drop_partial(img_path, e)
+            raise
+        manifest.mark_done(i, img_url, img_path)
+        return img_path
+
+    return save_or_skip
+
+def drop_partial(img_path, error):
+    """Clean up after a failed page: keep a body cut off by the network for a Range resume, drop anything else"""
+    if isinstance(error, RequestException):
+        return
+    part_path = img_path + ".part"
+    for leftover in (part_path, part_path + ".validator"):
+        if os.path.exists(leftover):
+            os.remove(leftover)
+
+def span_labels(chat_id, OUTPUT_DIR, chapter_num):
+    """Labels for the spans of one chapter download (OUTPUT_DIR is the series folder)"""
+    return {"chat_id": chat_id, "slug": os.path.basename(os.path.normpath(OUTPUT_DIR)), "chapter": chapter_num}
+
+def get_chapter_folder(OUTPUT_DIR, chapter_num, big=False):
+    suffix = "-big" if big else ""
+    return os.path.join(OUTPUT_DIR, f"chapter-{chapter_num}{suffix}")
+
+def download_to_file(img_url, path, labels=None):
+    """Copy an image from the page cache, or stream it from upstream to disk chunk by chunk
+
+    A partial file left by an interrupted download is resumed with an HTTP Range
+    request, guarded by If-Range so a changed image is fetched whole.
+    """
+    if page_cache.enabled():
+        hit = page_cache.fetch(img_url, path)
+        metrics.cache_requests.inc(cache="page", result="hit" if hit else "miss")
+        if hit:
+            return
+    with metrics.span("image_fetch", **(labels or {})):
+        _stream_to_file(img_url, path)
+    page_cache.store(img_url, path)
+
+def _validator(resp):
+    """Strong ETag, else Last-Modified, of a response: what If-Range can compare against; None without either"""
+    etag = resp.headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return resp.headers.get("Last-Modified")
+
+def _stream_to_file(img_url, path):
+    # The validator of the body in `path` is kept beside it, so a resume only
+    # appends when the server still has the same image (If-Range)
+    validator_path = path + ".validator"
+    offset = os.path.getsize(path) if os.path.exists(path) else 0
+    headers = {}
+    if offset:
+        try:
+            with open(validator_path) as f:
+                headers = {"Range": f"bytes={offset}-", "If-Range": f.read()}
+        except FileNotFoundError:
+            pass  # nothing to check the partial body against; fetch it again
+    with http_client.get(img_url, stream=True, headers=headers) as img_resp:
+        if headers and img_resp.status_code == 416:
+            # Nothing left past the offset: the earlier run already got the whole body
+            pass
+        else:
+            img_resp.raise_for_status()
+            # A changed image, or a server that ignores Range, answers 200 with the full body
+            resumed = bool(headers) and img_resp.status_code == 206
+            if not resumed:
+                validator = _validator(img_resp)
+                if validator:
+                    with open(validator_path, "w") as f:
+                        f.write(validator)
+                elif os.path.exists(validator_path):
+                    os.remove(validator_path)
+            with open(path, "ab" if resumed else "wb") as f:
+                for chunk in img_resp.iter_content(CHUNK_SIZE):
+                    f.write(chunk)
+                    metrics.downloaded_bytes.inc(len(chunk), kind="image")
+    if os.path.exists(validator_path):
+        os.remove(validator_path)
+
+def finish_page_normal(part_path, img_path, labels=None):
+    """Keep a downloaded RGB/greyscale JPEG byte-for-byte; transcode PNG, paletted and CMYK pages"""
+    from PIL import Image
+    with Image.open(part_path) as img:
+        passthrough = is_passthrough_jpeg(img)
+    if passthrough:
+        os.replace(part_path, img_path)
+        return
+    labels = labels or {}
+    with imaging.decode_budget.reserve(imaging.decoded_size(part_path)):
+        with Image.open(part_path) as img:
+            with metrics.span("decode", **labels):
+                img.load()
+            with metrics.span("encode", **labels):
+                img.convert("RGB").save(img_path, "JPEG")
+    os.remove(part_path)
 
 def download_chapter(chapter_url, chapter_num, OUTPUT_DIR, chat_id=None, user_cancel=None):
     print(f"[*] Mengambil gambar dari {chapter_url}")
-    resp = requests.get(chapter_url, headers={"User-Agent": "Mozilla/5.0"})
-    if resp.status_code != 200:
-        print(f"[!] Gagal mengakses {chapter_url}")
-        return []
-
-    soup = BeautifulSoup(resp.text, "html.parser")
-    img_tags = soup.select("img")
-    img_urls = []
-
-    for img in img_tags:
-        src = img.get("src") or img.get("data-src")
-        if src and (src.endswith(".jpg") or src.endswith(".png")):
-            # Skip advertisement and non-content images
-            if "komikuplus" in src or "asset/img" in src:
-                continue
-            if not src.startswith("http"):
-                if src.startswith("//"):
-                    src = "https:" + src
-                elif src.startswith("/"):
-                    src = "https://komiku.org" + src
-                else:
-                    src = "https://" + src
-            img_urls.append(src)
-
-    if not img_urls:
-        print(f"[!] Tidak ada gambar ditemukan di {chapter_url}")
+    labels = span_labels(chat_id, OUTPUT_DIR, chapter_num)
+    img_urls = extractor.chapter_pages(chapter_url, labels=labels)
+    if img_urls is None:
         return []
 
-    chapter_folder = os.path.join(OUTPUT_DIR, f"chapter-{chapter_num}")
+    chapter_folder = get_chapter_folder(OUTPUT_DIR, chapter_num)
     os.makedirs(chapter_folder, exist_ok=True)
 
-    images = []
-    for i, img_url in enumerate(img_urls, start=1):
-        # Check for cancellation
-        if user_cancel and chat_id and user_cancel.get(chat_id):
-            print(f"[!] Download cancelled for chapter {chapter_num}")
-            return []
-            
-        try:
-            img_resp = requests.get(img_url, stream=True)
-            img = Image.open(BytesIO(img_resp.content)).convert("RGB")
-            img_path = os.path.join(chapter_folder, f"{i:03}.jpg")
-            img.save(img_path, "JPEG")
-            images.append(img_path)
-            print(f"    > Download gambar {i}/{len(img_urls)}")
-        except Exception as e:
-            print(f"    [!] Gagal download {img_url}: {e}")
+    def save_page(i, img_url, img_path):
+        part_path = img_path + ".part"
+        download_to_file(img_url, part_path, labels)
+        finish_page_normal(part_path, img_path, labels)
+        print(f"    > Download gambar {i}")
+
+    try:
+        images = fetch_pages(img_urls, resumable(save_page, chapter_folder, chapter_url), chat_id, user_cancel)
+    finally:
+        img_urls.close()
+    if images is None:
+        print(f"[!] Download cancelled for chapter {chapter_num}")
+        return []
+    if not img_urls.urls:
+        print(f"[!] Tidak ada gambar ditemukan di {chapter_url}")
 
     return images
 
 def download_chapter_big(chapter_url, chapter_num, OUTPUT_DIR, chat_id=None, user_cancel=None):
     """Download chapter with larger dimensions and higher quality images for /big mode"""
     print(f"[*] BIG MODE: Mengambil gambar dari {chapter_url}")
-    resp = requests.get(chapter_url, headers={"User-Agent": "Mozilla/5.0"})
-    if resp.status_code != 200:
-        print(f"[!] Gagal mengakses {chapter_url}")
+    labels = span_labels(chat_id, OUTPUT_DIR, chapter_num)
+    img_urls = extractor.chapter_pages(chapter_url, big=True, labels=labels)
+    if img_urls is None:
         return []
 
-    soup = BeautifulSoup(resp.text, "html.parser")
-    img_tags = soup.select("img")
-    img_urls = []
-
-    for img in img_tags:
-        src = img.get("src") or img.get("data-src")
-        if src and (src.endswith(".jpg") or src.endswith(".png")):
-            # Skip advertisement and non-content images
-            if "komikuplus" in src or "asset/img" in src:
-                continue
-            if not src.startswith("http"):
-                if src.startswith("//"):
-                    src = "https:" + src
-                elif src.startswith("/"):
-                    src = "https://komiku.org" + src
-                else:
-                    src = "https://" + src
-            
-            # Try to get higher resolution image for BIG mode
-            # Replace common size indicators with larger versions
-            if "?resize=" in src:
-                src = src.split("?resize=")[0]  # Remove resize parameter
-            elif "thumb" in src:
-                src = src.replace("thumb", "full")  # Replace thumb with full
-            elif "_small" in src:
-                src = src.replace("_small", "_large")  # Replace small with large
-            elif "_medium" in src:
-                src = src.replace("_medium", "_large")  # Replace medium with large
-                
-            img_urls.append(src)
-
-    if not img_urls:
-        print(f"[!] Tidak ada gambar ditemukan di {chapter_url}")
+    chapter_folder = get_chapter_folder(OUTPUT_DIR, chapter_num, big=True)
+    os.makedirs(chapter_folder, exist_ok=True)
+
+    def save_page(i, img_url, img_path):
+        part_path = img_path + ".part"
+        download_to_file(img_url, part_path, labels)
+        # Resize/encode runs in the process pool so it doesn't stall other handlers
+        (original_width, original_height), (new_width, new_height) = imaging.upscale(part_path, img_path, labels)
+        print(f"    > BIG MODE: Download gambar {i} - Ukuran: {original_width}x{original_height} → {new_width}x{new_height}")
+
+    try:
+        images = fetch_pages(img_urls, resumable(save_page, chapter_folder, chapter_url), chat_id, user_cancel)
+    finally:
+        img_urls.close()
+    if images is None:
+        print(f"[!] BIG MODE download cancelled for chapter {chapter_num}")
         return []
+    if not img_urls.urls:
+        print(f"[!] Tidak ada gambar ditemukan di {chapter_url}")
 
-    chapter_folder = os.path.join(OUTPUT_DIR, f"chapter-{chapter_num}-big")
-    os.makedirs(chapter_folder, exist_ok=True)
+    return images
 
-    images = []
-    for i, img_url in enumerate(img_urls, start=1):
-        # Check for cancellation
-        if user_cancel and chat_id and user_cancel.get(chat_id):
-            print(f"[!] BIG MODE download cancelled for chapter {chapter_num}")
+def download_chapters(chapters, OUTPUT_DIR, chat_id=None, user_cancel=None, big=False, slots=None, owner=None):
+    """Yield (chapter_num, images) in chapter order while up to CHAPTER_WORKERS later chapters download ahead
+
+    chapters is a list of (chapter_num, chapter_url). slots, when given, is a
+    semaphore held around each chapter download (the global chapter cap).
+    Concurrent requests for the same chapter folder share one download; with
+    owner, each folder is leased to it until released via chapter_leases.
+    """
+    download_func = download_chapter_big if big else download_chapter
+    if PAGE_PIPELINE == "asyncio":
+        from pipeline import download_chapter_pipeline  # pipeline imports this module
+        download_func = functools.partial(download_chapter_pipeline, big=big)
+
+    def run(chapter_num, chapter_url, cancel):
+        if slots is None:
+            return download_func(chapter_url, chapter_num, OUTPUT_DIR, chat_id, cancel)
+        with slots:
+            return download_func(chapter_url, chapter_num, OUTPUT_DIR, chat_id, cancel)
+
+    def download(chapter_num, chapter_url):
+        if is_cancelled(chat_id, user_cancel):
             return []
-            
-        try:
-            img_resp = requests.get(img_url, stream=True)
-            img = Image.open(BytesIO(img_resp.content))
-            
-            # Get original dimensions
-            original_width, original_height = img.size
-            
-            # Upscale image for BIG mode (increase by 150%)
-            new_width = int(original_width * 1.5)
-            new_height = int(original_height * 1.5)
-            
-            # Resize using high-quality resampling
-            img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            
-            # Convert to RGB if necessary
-            if img_resized.mode != "RGB":
-                img_resized = img_resized.convert("RGB")
-            
-            img_path = os.path.join(chapter_folder, f"{i:03}.jpg")
-            # Save with maximum quality for BIG mode
-            img_resized.save(img_path, "JPEG", quality=100, optimize=False)
-            images.append(img_path)
-            print(f"    > BIG MODE: Download gambar {i}/{len(img_urls)} - Ukuran: {original_width}x{original_height} → {new_width}x{new_height}")
-        except Exception as e:
-            print(f"    [!] Gagal download {img_url}: {e}")
+        folder = get_chapter_folder(OUTPUT_DIR, chapter_num, big)
+        if owner is not None:
+            chapter_leases.acquire(folder, owner)
+        return chapter_flights.do(
+            folder,
+            lambda cancel: run(chapter_num, chapter_url, cancel),
+            lambda: is_cancelled(chat_id, user_cancel),
+        )
 
-    return images
+    width = max(1, CHAPTER_WORKERS)
+    pool = ThreadPoolExecutor(max_workers=width, thread_name_prefix="chapter")
+    futures = []
+    try:
+        # Keep a sliding window of `width` chapters in flight ahead of the consumer
+        for chapter_num, chapter_url in chapters[:width]:
+            futures.append(pool.submit(download, chapter_num, chapter_url))
+        for index, (chapter_num, _) in enumerate(chapters):
+            images = futures[index].result()
+            if index + width < len(chapters):
+                next_num, next_url = chapters[index + width]
+                futures.append(pool.submit(download, next_num, next_url))
+            if is_cancelled(chat_id, user_cancel):
+                return
+            yield chapter_num, images
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
 
 def create_pdf(all_images, output_pdf):
     if not all_images:
         print("[!] Tidak ada gambar untuk dibuat PDF.")
         return
-    pil_images = [Image.open(img_path).convert("RGB") for img_path in all_images]
-    pil_images[0].save(output_pdf, save_all=True, append_images=pil_images[1:])
-    print(f"[+] PDF dibuat: {output_pdf}")
\ No newline at end of file
+    # Pages are streamed into the file one at a time instead of being held in memory
+    with metrics.span("pdf_build"), PdfWriter(output_pdf) as pdf:
+        for img_path in all_images:
+            pdf.add_image(img_path)
+    print(f"[+] PDF dibuat: {output_pdf}")
@@ -0,0 +1,255 @@
+# extractor.py
+# Page image URLs of a chapter, shared by normal and big mode. The chapter HTML
+# is streamed through a stdlib HTMLParser that only collects <img> tags inside
+# komiku's reader container (id="Baca_Komik"). URLs are handed out while the
+# rest of the page is still arriving, so the first pages start downloading
+# before the HTML is fully parsed, and reading stops once the container closes.
+#
+# Lazy-loaded pages are picked up from data-src / srcset; URLs with query
+# strings and .webp pages are accepted. Each chapter's page list is cached per
+# chapter URL with the normal and big-mode URL of every page, so switching
+# modes doesn't refetch the chapter.
+import codecs
+import os
+import threading
+import time
+from collections import OrderedDict
+from html.parser import HTMLParser
+from urllib.parse import parse_qsl, urlencode, urljoin, urlsplit, urlunsplit
+import requests
+import http_client
+import metrics
+
+# Reader container ids; pages outside it are only used when a page has none
+READER_IDS = ("Baca_Komik",)
+PAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+# Advertisement and site chrome images
+SKIP_MARKERS = ("komikuplus", "asset/img")
+# Attributes holding the real image URL, in order of preference; lazy loaders
+# put a placeholder in src and the page in data-src
+SRC_ATTRS = ("data-src", "data-lazy-src", "data-original", "src")
+SRCSET_ATTRS = ("data-srcset", "srcset")
+# Query parameters image hosts use to serve a scaled-down copy
+SIZE_PARAMS = ("resize", "w", "h", "width", "height", "fit", "quality")
+
+HTML_CHUNK_SIZE = 16 * 1024
+PAGE_LIST_CACHE_SIZE = int(os.getenv("PAGE_LIST_CACHE_SIZE", "512"))
+PAGE_LIST_TTL = int(os.getenv("PAGE_LIST_TTL", "3600"))
+
+_cache = OrderedDict()  # chapter_url -> (fetched, [(normal url, big url)])
+_lock = threading.Lock()
+
+class ReaderParser(HTMLParser):
+    """Collects the attributes of <img> tags inside the reader container as the HTML is fed in"""
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self.container = None  # tag name of the reader container once it is found
+        self.depth = 0
+        self.closed = False
+        self.found = []    # images inside the container, drained by the caller
+        self.outside = []  # images anywhere else on the page
+
+    def handle_starttag(self, tag, attrs):
+        if self.closed:
+            return
+        if self.container is None:
+            if tag != "img" and dict(attrs).get("id") in READER_IDS:
+                self.container = tag
+                self.depth = 1
+            elif tag == "img":
+                self.outside.append(attrs)
+            return
+        if tag == self.container:
+            self.depth += 1
+        elif tag == "img":
+            self.found.append(attrs)
+
+    def handle_endtag(self, tag):
+        if self.container and not self.closed and tag == self.container:
+            self.depth -= 1
+            self.closed = self.depth == 0
+
+def is_page_image(src):
+    path = urlsplit(src).path.lower()
+    return path.endswith(PAGE_EXTENSIONS) and not any(marker in src for marker in SKIP_MARKERS)
+
+def resolve(base_url, src):
+    if src.startswith("//"):
+        return "https:" + src
+    if urlsplit(src).scheme:
+        return src
+    if src.startswith(("/", ".")):
+        return urljoin(base_url, src)
+    # komiku sometimes leaves the scheme off a CDN host ("cdn.komiku.org/...")
+    return "https://" + src
+
+def largest_srcset(value):
+    """The srcset candidate with the biggest width (or density) descriptor"""
+    best, best_size = None, -1.0
+    for candidate in value.split(","):
+        parts = candidate.split()
+        if not parts:
+            continue
+        size = 1.0
+        if len(parts) > 1 and parts[1][:-1].replace(".", "", 1).isdigit():
+            size = float(parts[1][:-1])
+        if size > best_size:
+            best, best_size = parts[0], size
+    return best
+
+def big_url(url):
+    """Higher resolution variant of a page URL for /komik (big mode)"""
+    scheme, netloc, path, query, fragment = urlsplit(url)
+    params = parse_qsl(query, keep_blank_values=True)
+    kept = [(key, value) for key, value in params if key.lower() not in SIZE_PARAMS]
+    if len(kept) != len(params):
+        return urlunsplit((scheme, netloc, path, urlencode(kept), fragment))
+    if "thumb" in path:
+        path = path.replace("thumb", "full")
+    elif "_small" in path:
+        path = path.replace("_small", "_large")
+    elif "_medium" in path:
+        path = path.replace("_medium", "_large")
+    return urlunsplit((scheme, netloc, path, query, fragment))
+
+def page_urls(attrs, base_url):
+    """(normal url, big url) of one <img>, or None when it isn't a chapter page"""
+    attrs = dict(attrs)
+    srcs = [attrs.get(name) for name in SRC_ATTRS]
+    srcs = [src.strip() for src in srcs if src and not src.startswith("data:") and is_page_image(src.strip())]
+    srcset = next((largest_srcset(attrs[name]) for name in SRCSET_ATTRS if attrs.get(name)), None)
+    if srcset and not is_page_image(srcset):
+        srcset = None
+    normal = srcs[0] if srcs else srcset
+    if not normal:
+        return None
+    normal = resolve(base_url, normal)
+    # Big mode prefers the largest srcset entry over the default src
+    big = resolve(base_url, srcset) if srcset else normal
+    return normal, big_url(big)
+
+def _stream(resp, chapter_url, labels):
+    """Yield (normal url, big url) pairs while the chapter HTML is read and parsed chunk by chunk
+
+    http_client.get only retries resets that happen before it returns, so a
+    body cut off mid-stream is refetched here; parsing starts over and pages
+    already handed out are skipped.
+    """
+    base_url = resp.url or chapter_url
+    seen = set()
+    parse_seconds = 0.0
+    received = 0
+    attempt = 0
+
+    def drain(found):
+        for attrs in found:
+            urls = page_urls(attrs, base_url)
+            if urls and urls[0] not in seen:
+                seen.add(urls[0])
+                yield urls
+        found.clear()
+
+    try:
+        while True:
+            parser = ReaderParser()
+            decoder = codecs.getincrementaldecoder(resp.encoding or "utf-8")(errors="replace")
+            try:
+                for chunk in resp.iter_content(HTML_CHUNK_SIZE):
+                    received += len(chunk)
+                    started = time.perf_counter()
+                    parser.feed(decoder.decode(chunk))
+                    parse_seconds += time.perf_counter() - started
+                    yield from drain(parser.found)
+                    if parser.closed:
+                        # Everything after the reader is comments and footer
+                        break
+                else:
+                    started = time.perf_counter()
+                    parser.feed(decoder.decode(b"", final=True))
+                    parser.close()
+                    parse_seconds += time.perf_counter() - started
+                    yield from drain(parser.found)
+                break
+            except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+                resp.close()
+                if attempt >= http_client.HTTP_RETRIES:
+                    raise
+                print(f"[*] Mengulang {chapter_url}: {e}")
+                time.sleep(http_client.backoff(attempt))
+                attempt += 1
+                resp = http_client.get(chapter_url, stream=True)
+                resp.raise_for_status()
+        if parser.container is None:
+            # Unknown layout: fall back to every page-like image on the page
+            yield from drain(parser.outside)
+    finally:
+        resp.close()
+        metrics.downloaded_bytes.inc(received, kind="html")
+        metrics.observe("html_parse", parse_seconds, **labels)
+
+class PageStream:
+    """The page URLs of one chapter, produced lazily; iterate it once, then close() it
+
+    urls holds every URL handed out so far. A fully read page list is cached
+    for the chapter URL.
+    """
+
+    def __init__(self, pages, big=False, chapter_url=None):
+        self.pages = pages
+        self.big = big
+        self.chapter_url = chapter_url  # set when the list is being parsed and should be cached
+        self.urls = []
+
+    def __iter__(self):
+        collected = []
+        for pair in self.pages:
+            collected.append(pair)
+            url = pair[1] if self.big else pair[0]
+            self.urls.append(url)
+            yield url
+        if self.chapter_url and collected:
+            _remember(self.chapter_url, collected)
+
+    def close(self):
+        """Stop reading the chapter HTML (when iteration stopped early, e.g. on cancel)"""
+        close = getattr(self.pages, "close", None)
+        if close:
+            close()
+
+def _cached(chapter_url):
+    with _lock:
+        entry = _cache.get(chapter_url)
+        if entry is None:
+            return None
+        if time.time() - entry[0] >= PAGE_LIST_TTL:
+            del _cache[chapter_url]
+            return None
+        _cache.move_to_end(chapter_url)
+        return entry[1]
+
+def _remember(chapter_url, pages):
+    if PAGE_LIST_CACHE_SIZE <= 0:
+        return
+    with _lock:
+        _cache[chapter_url] = (time.time(), pages)
+        _cache.move_to_end(chapter_url)
+        while len(_cache) > PAGE_LIST_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def chapter_pages(chapter_url, big=False, labels=None):
+    """PageStream of a chapter's page image URLs, or None if the chapter page can't be fetched"""
+    labels = labels or {}
+    pages = _cached(chapter_url)
+    metrics.cache_requests.inc(cache="page_list", result="hit" if pages else "miss")
+    if pages:
+        return PageStream(iter(pages), big)
+
+    # Only the response head is awaited here; the body is read as the stream is consumed
+    with metrics.span("html_fetch", **labels):
+        resp = http_client.get(chapter_url, stream=True)
+    if resp.status_code != 200:
+        print(f"[!] Gagal mengakses {chapter_url}")
+        resp.close()
+        return None
+    return PageStream(_stream(resp, chapter_url, labels), big, chapter_url)
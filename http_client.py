@@ -0,0 +1,71 @@
+# http_client.py
+import os
+import random
+import time
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ProtocolError, ReadTimeoutError
+from urllib3.util.retry import Retry
+import rate_limit
+
+USER_AGENT = "Mozilla/5.0"
+CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "5"))
+READ_TIMEOUT = float(os.getenv("HTTP_READ_TIMEOUT", "30"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "4"))
+# Keep enough pooled connections per host for every concurrent page fetch
+POOL_SIZE = int(os.getenv("HTTP_POOL_SIZE", os.getenv("MAX_PAGE_FETCHES", "16")))
+# Number of hosts (komiku.org, image CDNs) that keep their own keep-alive pool
+POOL_HOSTS = int(os.getenv("HTTP_POOL_HOSTS", "8"))
+
+RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+def _build_session():
+    retry = Retry(
+        total=HTTP_RETRIES,
+        connect=HTTP_RETRIES,
+        read=HTTP_RETRIES,
+        status=HTTP_RETRIES,
+        backoff_factor=0.5,
+        backoff_jitter=0.5,
+        backoff_max=10,
+        status_forcelist=RETRY_STATUSES,
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        respect_retry_after_header=True,
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=POOL_HOSTS, pool_maxsize=POOL_SIZE, pool_block=True, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    session.headers["User-Agent"] = USER_AGENT
+    return session
+
+session = _build_session()
+
+def backoff(attempt):
+    return min(10, 0.5 * (2 ** attempt)) + random.uniform(0, 0.5)
+
+def body_cut_off(error):
+    """True for a response body that broke off while it was being read
+
+    Connect failures and error statuses arrive as MaxRetryError once urllib3
+    has used up its own retries, and are not retried again on top of that.
+    """
+    if isinstance(error, requests.exceptions.ChunkedEncodingError):
+        return True
+    cause = error.args[0] if error.args else None
+    return isinstance(cause, (ProtocolError, ReadTimeoutError))
+
+def get(url, **kwargs):
+    """GET through the shared session with timeouts and the upstream rate limit; retries bodies cut off by a connection reset"""
+    kwargs.setdefault("timeout", (CONNECT_TIMEOUT, READ_TIMEOUT))
+    attempt = 0
+    while True:
+        rate_limit.upstream.wait(url)
+        try:
+            return session.get(url, **kwargs)
+        except (requests.exceptions.ChunkedEncodingError, requests.exceptions.ConnectionError) as e:
+            if attempt >= HTTP_RETRIES or not body_cut_off(e):
+                raise
+            time.sleep(backoff(attempt))
+            attempt += 1
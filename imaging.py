@@ -0,0 +1,148 @@
+# imaging.py
+# CPU-heavy page transforms for /komik (big mode). They run in a process pool so
+# the LANCZOS resize and JPEG encode don't hold the GIL of the bot process.
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import contextmanager
+import metrics
+
+BIG_SCALE = 1.5
+# Worker processes for big-mode transforms; 1 (or a single-core host) keeps the work in-process
+IMAGE_WORKERS = int(os.getenv("IMAGE_WORKERS", str(os.cpu_count() or 1)))
+
+# Estimated decoded-bitmap bytes this process lets pages hold at once; 0 disables the limit
+DECODE_BUDGET_MB = int(os.getenv("DECODE_BUDGET_MB", "512"))
+
+_pool = None
+_pool_lock = threading.Lock()
+
+class MemoryBudget:
+    """Makes new page decodes wait while the pages already being decoded would exceed the budget"""
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+        self.cond = threading.Condition()
+
+    @contextmanager
+    def reserve(self, nbytes):
+        if self.limit <= 0:
+            yield
+            return
+        # A page bigger than the whole budget may still run, just on its own
+        nbytes = min(nbytes, self.limit)
+        with self.cond:
+            while self.used and self.used + nbytes > self.limit:
+                self.cond.wait()
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self.cond:
+                self.used -= nbytes
+                self.cond.notify_all()
+
+decode_budget = MemoryBudget(DECODE_BUDGET_MB * 1024 * 1024)
+
+def decoded_size(path, scale=1.0):
+    """Estimated bytes needed to decode the image at path (plus the resized copy when scale != 1), read from its header"""
+    # Pillow is imported on first use throughout, keeping it off the bot's startup path
+    from PIL import Image
+    with Image.open(path) as img:
+        width, height = img.size
+        bands = max(3, len(img.getbands()))
+    size = width * height * bands
+    if scale != 1.0:
+        size += int(width * scale) * int(height * scale) * 3
+    return size
+
+def _upscale(img, img_path, timings):
+    from PIL import Image
+    started = time.perf_counter()
+    img.load()
+    timings["decode"] = time.perf_counter() - started
+
+    # Get original dimensions
+    original_width, original_height = img.size
+
+    # Upscale image for BIG mode (increase by 150%)
+    new_width = int(original_width * BIG_SCALE)
+    new_height = int(original_height * BIG_SCALE)
+
+    # Resize using high-quality resampling
+    started = time.perf_counter()
+    img_resized = img.resize((new_width, new_height), Image.Resampling.LANCZOS)
+    timings["resize"] = time.perf_counter() - started
+
+    # Convert to RGB if necessary
+    if img_resized.mode != "RGB":
+        img_resized = img_resized.convert("RGB")
+
+    # Save with maximum quality for BIG mode
+    started = time.perf_counter()
+    img_resized.save(img_path, "JPEG", quality=100, optimize=False)
+    timings["encode"] = time.perf_counter() - started
+    return (original_width, original_height), (new_width, new_height)
+
+def upscale_file(src_path, img_path):
+    """Upscale a downloaded page file into img_path and remove the source; returns (original size, new size, stage timings)"""
+    from PIL import Image
+    timings = {}
+    with Image.open(src_path) as img:
+        original_size, new_size = _upscale(img, img_path, timings)
+    os.remove(src_path)
+    return original_size, new_size, timings
+
+def start_pool():
+    """Start the worker processes; call before the process starts any thread
+
+    main.py does startup work (download cleanup, bot setup) at import time, so
+    workers are forked rather than spawned (spawn/forkserver re-import the
+    main module). Forking a process that already runs threads can leave a
+    child holding a lock some thread had at that moment, so every worker is
+    forked here, up front, instead of on the first big-mode page.
+    """
+    global _pool
+    if IMAGE_WORKERS <= 1:
+        return
+    with _pool_lock:
+        if _pool is not None:
+            return
+        methods = multiprocessing.get_all_start_methods()
+        context = multiprocessing.get_context("fork") if "fork" in methods else None
+        _pool = ProcessPoolExecutor(max_workers=IMAGE_WORKERS, mp_context=context)
+        # A forking pool launches all its workers on the first submit
+        _pool.submit(os.getpid).result()
+
+def run(func, *args):
+    """Run a transform in the worker pool, or inline when the pool isn't started, only one worker is configured or the pool broke"""
+    global _pool
+    pool = _pool
+    if pool is None:
+        return func(*args)
+    try:
+        return pool.submit(func, *args).result()
+    except BrokenProcessPool as e:
+        # A worker died (OOM kill, crash inside Pillow) and took the pool with it.
+        # Forking a new one now would copy this process's running threads, so
+        # the remaining work runs in-process until the bot restarts
+        with _pool_lock:
+            if _pool is pool:
+                _pool = None
+                print(f"❌ Image worker pool broke, transforming in-process from now on: {e}")
+        pool.shutdown(wait=False)
+        return func(*args)
+
+def upscale(src_path, img_path, labels=None):
+    """Big-mode transform of a downloaded page, throttled by the decode budget; returns (original size, new size)"""
+    # Reserved here rather than in the worker so the budget covers the whole pool
+    with decode_budget.reserve(decoded_size(src_path, BIG_SCALE)):
+        original_size, new_size, timings = run(upscale_file, src_path, img_path)
+    # Timed in the worker process, recorded here where the metrics live
+    for stage, seconds in timings.items():
+        metrics.observe(stage, seconds, **(labels or {}))
+    return original_size, new_size
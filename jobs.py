@@ -0,0 +1,160 @@
+# jobs.py
+# Download jobs run on a fixed pool of worker threads instead of inside the
+# Telegram handler threads. Pending jobs are kept per chat and picked round-robin
+# between chats (lowest priority number first), a chat never has more than one
+# job running, and chapter downloads across all jobs share one global cap.
+import itertools
+import os
+import threading
+import time
+from collections import deque
+import metrics
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "2"))
+# Chapters being downloaded at the same time across every job
+MAX_ACTIVE_CHAPTERS = int(os.getenv("MAX_ACTIVE_CHAPTERS", "3"))
+
+PRIORITY_USER = 0
+PRIORITY_DEMO = 10
+
+chapter_slots = threading.BoundedSemaphore(MAX_ACTIVE_CHAPTERS)
+
+# Job ids carry the pid, since every bot process on the host shares downloads/jobs/<job id>
+_job_ids = itertools.count(1)
+
+class Job:
+    """A unit of work for one chat; run() is called on a scheduler worker thread"""
+
+    def __init__(self, chat_id, run, priority=PRIORITY_USER, label=""):
+        self.id = f"{os.getpid()}-{next(_job_ids)}"
+        self.chat_id = chat_id
+        self.run = run
+        self.priority = priority
+        self.label = label
+        self.created = time.time()
+        self.position = 0  # queue position when submitted; 0 = started right away
+        self.cancelled = threading.Event()
+        self.done = threading.Event()
+
+class JobCancel:
+    """The user_cancel-style mapping a running job checks: true once the scheduler cancelled the job or flags has its chat cancelled"""
+
+    def __init__(self, job, flags=None):
+        self.job = job
+        self.flags = flags
+
+    def get(self, chat_id, default=None):
+        if self.job.cancelled.is_set():
+            return True
+        return bool(self.flags and self.flags.get(chat_id, default))
+
+class JobScheduler:
+    def __init__(self, workers=JOB_WORKERS, on_start=None, wait_stage="queue_wait", is_cancelled=None):
+        self._cond = threading.Condition()
+        self._queues = {}    # chat_id -> deque of pending jobs
+        self._ring = deque()  # chats with pending jobs, in round-robin order
+        self._active = {}    # chat_id -> running job
+        self._on_start = on_start
+        self._workers = workers
+        self._wait_stage = wait_stage
+        # Checked before a job starts, for cancels this scheduler wasn't told about
+        self._is_cancelled = is_cancelled
+        for i in range(workers):
+            worker = threading.Thread(target=self._worker, name=f"job-worker-{i}")
+            worker.daemon = True
+            worker.start()
+
+    def submit(self, job):
+        """Queue a job; returns its position in the queue (0 when a worker picks it up right away)"""
+        with self._cond:
+            if job.chat_id not in self._queues:
+                self._queues[job.chat_id] = deque()
+                self._ring.append(job.chat_id)
+            self._queues[job.chat_id].append(job)
+            job.position = self._position(job)
+            self._cond.notify()
+        return job.position
+
+    def cancel(self, chat_id):
+        """Drop a chat's pending jobs and flag its running job; returns how many jobs were affected"""
+        with self._cond:
+            pending = self._queues.pop(chat_id, deque())
+            if chat_id in self._ring:
+                self._ring.remove(chat_id)
+            for job in pending:
+                job.cancelled.set()
+                job.done.set()
+            running = self._active.get(chat_id)
+            if running:
+                running.cancelled.set()
+            return len(pending) + (1 if running else 0)
+
+    def pending_count(self):
+        with self._cond:
+            return sum(len(queue) for queue in self._queues.values())
+
+    def active_count(self):
+        with self._cond:
+            return len(self._active)
+
+    def _pick(self, queues, active, ring):
+        candidates = [chat_id for chat_id in ring if queues.get(chat_id) and chat_id not in active]
+        if not candidates:
+            return None
+        best = min(queues[chat_id][0].priority for chat_id in candidates)
+        chat_id = next(c for c in candidates if queues[c][0].priority == best)
+        # The chosen chat goes to the back of the ring so other chats get the next turn
+        ring.remove(chat_id)
+        ring.append(chat_id)
+        return queues[chat_id].popleft()
+
+    def _position(self, job):
+        # Replay the scheduling order on a copy of the queues to count the jobs ahead
+        queues = {chat_id: deque(queue) for chat_id, queue in self._queues.items()}
+        ring = deque(self._ring)
+        ahead = 0
+        while True:
+            picked = self._pick(queues, {}, ring)
+            if picked is job or picked is None:
+                break
+            ahead += 1
+        idle = self._workers - len(self._active)
+        if ahead < idle and job.chat_id not in self._active:
+            return 0
+        return ahead + 1
+
+    def _next_job(self):
+        job = self._pick(self._queues, self._active, self._ring)
+        if job is None:
+            return None
+        if not self._queues[job.chat_id]:
+            del self._queues[job.chat_id]
+            self._ring.remove(job.chat_id)
+        self._active[job.chat_id] = job
+        return job
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                job = self._next_job()
+                while job is None:
+                    self._cond.wait()
+                    job = self._next_job()
+            metrics.observe(self._wait_stage, time.time() - job.created, chat_id=job.chat_id)
+            try:
+                if self._is_cancelled and self._is_cancelled(job):
+                    job.cancelled.set()
+                    print(f"⛔ Job {job.id} ({job.label}) for user {job.chat_id} was cancelled before it started")
+                    continue
+                if self._on_start:
+                    self._on_start(job)
+                # Every span the job opens on this thread is labelled with its chat
+                with metrics.labels(chat_id=job.chat_id):
+                    job.run(job)
+            except Exception as e:
+                print(f"❌ Job {job.id} ({job.label}) for user {job.chat_id} failed: {e}")
+            finally:
+                with self._cond:
+                    self._active.pop(job.chat_id, None)
+                    self._cond.notify_all()
+                job.done.set()
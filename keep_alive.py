@@ -0,0 +1,55 @@
+# keep_alive.py
+import hmac
+import os
+from threading import Thread
+from flask import Flask, Response, abort, jsonify, request
+import metrics
+
+PORT = int(os.getenv("PORT", "8080"))
+# Required as "Authorization: Bearer <token>" for /spans, which shows every
+# chat's ids and requests; /spans is off while this is unset
+METRICS_TOKEN = os.getenv("METRICS_TOKEN", "")
+
+app = Flask(__name__)
+
+@app.route("/")
+def home():
+    return "Bot is alive!"
+
+@app.route("/metrics")
+def prometheus_metrics():
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
+
+@app.route("/spans")
+def spans():
+    # Recent stage timings with their chat_id/slug/chapter labels, newest last
+    if not METRICS_TOKEN:
+        abort(404)
+    if not hmac.compare_digest(request.headers.get("Authorization", ""), f"Bearer {METRICS_TOKEN}"):
+        abort(403)
+    return jsonify(metrics.recent_spans(request.args.get("limit", type=int)))
+
+def add_webhook(path, secret, handle):
+    """Accept Telegram updates POSTed to path; handle(update_dict) must only queue the update, not process it"""
+
+    def webhook():
+        # Telegram echoes the secret_token given to setWebhook in this header
+        sent = request.headers.get("X-Telegram-Bot-Api-Secret-Token", "")
+        if secret and not hmac.compare_digest(sent, secret):
+            abort(403)
+        update = request.get_json(force=True, silent=True)
+        if not isinstance(update, dict):
+            abort(400)
+        handle(update)
+        return ""
+
+    app.add_url_rule(path, "telegram_webhook", webhook, methods=["POST"])
+
+def run():
+    app.run(host="0.0.0.0", port=PORT)
+
+def keep_alive():
+    server_thread = Thread(target=run)
+    server_thread.daemon = True
+    server_thread.start()
+    return server_thread
@@ -0,0 +1,174 @@
+# layout.py
+# Page layout between download and create_pdf. Komiku serves webtoon chapters
+# as very tall strips, and each one used to become a single huge PDF page that
+# phone viewers render slowly or not at all. Strips that are too tall are cut
+# into page-sized pieces at whitespace rows (found with a vectorised
+# row-variance scan, so panels are not split), and with stitching enabled short
+# pieces are joined so every page ends up close to the same height.
+#
+# Cut pieces have to be re-encoded, while an untouched JPEG page goes into the
+# PDF byte for byte. So by default (auto) only strips more than
+# LAYOUT_MAX_PAGES target pages tall, or over the PDF page size limit, are cut.
+#
+# numpy and Pillow are imported by the functions that use them, so importing
+# this module at bot startup costs nothing until the first chapter is laid out.
+import os
+import imaging
+import metrics
+
+# Target page size as WIDTHxHEIGHT; pages keep the source width, so only the aspect ratio matters
+LAYOUT_PAGE_SIZE = os.getenv("LAYOUT_PAGE_SIZE", "800x1280")
+# off, auto (cut only very tall strips), slice (cut every strip taller than a
+# page) or stitch (slice, then join short pieces)
+PAGE_LAYOUT = os.getenv("PAGE_LAYOUT", "auto")
+# In auto mode, strips up to this many target pages tall are left whole
+LAYOUT_MAX_PAGES = float(os.getenv("LAYOUT_MAX_PAGES", "4"))
+# Largest page PDF viewers accept (14400pt, i.e. 200in), at one point per pixel
+PDF_MAX_PAGE_HEIGHT = 14400
+# Rows whose luminance variance is below this are treated as gutter / whitespace
+WHITESPACE_VARIANCE = float(os.getenv("WHITESPACE_VARIANCE", "25"))
+# A cut is searched for between MIN_FILL and SLACK times the page height
+MIN_FILL = 0.6
+# Pieces up to this much taller than a page are kept whole instead of cut again
+SLACK = 1.25
+LAYOUT_QUALITY = 95
+# Rows scanned per block, so the float variance buffer stays small on long strips
+_SCAN_ROWS = 1024
+
+def enabled():
+    return PAGE_LAYOUT in ("auto", "slice", "stitch")
+
+def parse_page_size(value):
+    width, height = value.lower().split("x")
+    return int(width), int(height)
+
+def whitespace_rows(img):
+    """Boolean array with True for every row of img that is one flat colour"""
+    import numpy as np
+    gray = np.asarray(img.convert("L"))
+    blank = np.empty(gray.shape[0], dtype=bool)
+    for top in range(0, gray.shape[0], _SCAN_ROWS):
+        block = gray[top:top + _SCAN_ROWS].astype(np.float32)
+        blank[top:top + len(block)] = block.var(axis=1) < WHITESPACE_VARIANCE
+    return blank
+
+def cut_points(blank, page_height):
+    """Rows at which a strip is cut so no piece is much taller than page_height"""
+    import numpy as np
+    cuts = []
+    top = 0
+    height = len(blank)
+    min_fill = int(page_height * MIN_FILL)
+    max_fill = int(page_height * SLACK)
+    while height - top > max_fill:
+        window = np.flatnonzero(blank[top + min_fill:top + max_fill]) + min_fill
+        # Cut at the blank row nearest the ideal page end, or hard at the page end
+        if len(window):
+            cut = top + int(window[np.abs(window - page_height).argmin()])
+        else:
+            cut = top + page_height
+        cuts.append(cut)
+        top = cut
+    return cuts
+
+def derived_path(src_path, suffix, out_dir=None):
+    """Path for a file made from src_path: next to it, or in out_dir prefixed with the chapter folder name"""
+    stem = os.path.splitext(src_path)[0]
+    if out_dir is None:
+        return f"{stem}{suffix}.jpg"
+    chapter = os.path.basename(os.path.dirname(src_path))
+    return os.path.join(out_dir, f"{chapter}-{os.path.basename(stem)}{suffix}.jpg")
+
+class PageLayout:
+    """Turns downloaded pages into PDF pages one source page at a time
+
+    Each piece is (source path, index, cropped image or None for the untouched
+    source, (width, height)).
+    """
+
+    def __init__(self, page_size=None, stitch=None, out_dir=None):
+        width, height = page_size or parse_page_size(LAYOUT_PAGE_SIZE)
+        self.ratio = height / width
+        self.stitch = PAGE_LAYOUT == "stitch" if stitch is None else stitch
+        # Tallest page left whole, in target page heights
+        self.max_pages = LAYOUT_MAX_PAGES if PAGE_LAYOUT == "auto" and not self.stitch else SLACK
+        # Where new pages go; None writes them next to their source page
+        self.out_dir = out_dir
+        self.pending = []
+        self.pending_height = 0
+
+    def add(self, img_path):
+        """Lay out one downloaded page; returns the page paths finished so far (may be none when stitching)"""
+        pages = []
+        for piece in self._slice(img_path):
+            if not self.stitch:
+                pages.append(self._write([piece]))
+                continue
+            width, height = piece[3]
+            fits = self.pending_height + height <= width * self.ratio * SLACK
+            if self.pending and (self.pending[0][3][0] != width or not fits):
+                pages.append(self._flush())
+            self.pending.append(piece)
+            self.pending_height += height
+        return pages
+
+    def finish(self):
+        """Write out whatever is still waiting to be stitched"""
+        return [self._flush()] if self.pending else []
+
+    def _flush(self):
+        page = self._write(self.pending)
+        self.pending = []
+        self.pending_height = 0
+        return page
+
+    def _slice(self, img_path):
+        from PIL import Image
+        with Image.open(img_path) as img:
+            width, height = img.size
+        # Pieces may run SLACK over a page, and must still fit the PDF limit
+        page_height = min(int(width * self.ratio), int(PDF_MAX_PAGE_HEIGHT / SLACK))
+        if height <= min(page_height * self.max_pages, PDF_MAX_PAGE_HEIGHT):
+            # Short pages are not decoded at all unless they get stitched
+            yield img_path, 0, None, (width, height)
+            return
+        # Held while the pieces are consumed, since they share the decoded strip's memory
+        with imaging.decode_budget.reserve(imaging.decoded_size(img_path)):
+            with Image.open(img_path) as img:
+                strip = img.convert("RGB")
+            cuts = cut_points(whitespace_rows(strip), page_height)
+            for index, (top, bottom) in enumerate(zip([0] + cuts, cuts + [height]), start=1):
+                yield img_path, index, strip.crop((0, top, width, bottom)), (width, bottom - top)
+
+    def _write(self, pieces):
+        from PIL import Image
+        src_path, index, image, (width, _) = pieces[0]
+        if len(pieces) == 1 and image is None:
+            return src_path
+        out_path = derived_path(src_path, f"-{index:02}", self.out_dir)
+        if len(pieces) == 1:
+            image.save(out_path, "JPEG", quality=LAYOUT_QUALITY)
+            return out_path
+        page = Image.new("RGB", (width, sum(piece[3][1] for piece in pieces)), "white")
+        top = 0
+        for piece_src, _, piece_image, (_, piece_height) in pieces:
+            if piece_image is None:
+                with Image.open(piece_src) as source:
+                    page.paste(source.convert("RGB"), (0, top))
+            else:
+                page.paste(piece_image, (0, top))
+            top += piece_height
+        page.save(out_path, "JPEG", quality=LAYOUT_QUALITY)
+        return out_path
+
+def layout_pages(images, page_size=None, stitch=None, out_dir=None):
+    """Page paths for one chapter after slicing (and optionally stitching); images are returned as-is when layout is off"""
+    if not enabled() or not images:
+        return images
+    layout = PageLayout(page_size, stitch, out_dir)
+    pages = []
+    with metrics.span("layout"):
+        for img_path in images:
+            pages.extend(layout.add(img_path))
+        pages.extend(layout.finish())
+    return pages
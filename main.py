@@ -1,58 +1,203 @@
+import hashlib
 import os
 import shutil
+import tempfile
 import requests
-from bs4 import BeautifulSoup
 import telebot
-from telebot import types
-from downloader import download_chapter, create_pdf, download_chapter_big
-from keep_alive import keep_alive
+from telebot import apihelper, types
+from downloader import download_chapters, create_pdf, get_chapter_folder, is_complete
+from layout import layout_pages
+import size_budget
+from cbz_writer import CbzParts
+from singleflight import chapter_leases
+import http_client
+import result_cache
+import metadata
+import jobs
+import rate_limit
+import metrics
+import state_store
+import uploader
+from manifest import has_manifest
 import time
 import threading
-import gc
+import imaging
+
+# Image workers are forked before any thread of this process exists
+imaging.start_pool()
 
 TOKEN = os.getenv("BOT_TOKEN")
+# Public HTTPS base URL of this server. When set, Telegram pushes updates to
+# <WEBHOOK_URL>/telegram/webhook on the keep-alive server instead of the bot
+# long-polling for them
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").rstrip("/")
+WEBHOOK_PATH = "/telegram/webhook"
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or (hashlib.sha256(TOKEN.encode()).hexdigest()[:32] if TOKEN else "")
+# Updates handled at once in webhook mode; each chat's updates still run one at a time, in order
+UPDATE_WORKERS = int(os.getenv("UPDATE_WORKERS", "8"))
+# Bot API server to talk to instead of api.telegram.org (a self-hosted or fake one)
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+if TELEGRAM_API_URL:
+    apihelper.API_URL = TELEGRAM_API_URL + "/bot{0}/{1}"
+    apihelper.FILE_URL = TELEGRAM_API_URL + "/file/bot{0}/{1}"
+# Chapter folders live in downloads/<slug>/ and are shared between jobs; the
+# PDFs, CBZs and re-encoded pages of one job go to downloads/jobs/<job id>/, where
+# the job id is <pid>-<n> (see jobs.Job)
 OUTPUT_DIR = "downloads"
+JOBS_DIR = os.path.join(OUTPUT_DIR, "jobs")
+# Stale folders found at startup are renamed in here and deleted in the background.
+# It sits inside downloads/ so the rename never crosses a filesystem boundary
+TRASH_DIR = os.path.join(OUTPUT_DIR, ".trash")
 os.makedirs(OUTPUT_DIR, exist_ok=True)
 
-# Clean up downloads folder on startup
+# Chapter folders with a manifest are kept this long so an interrupted job can resume
+RESUME_TTL = int(os.getenv("RESUME_TTL", str(24 * 3600)))
+
+def is_resumable(folder):
+    return has_manifest(folder) and time.time() - os.path.getmtime(folder) < RESUME_TTL
+
+def series_dir(slug):
+    return os.path.join(OUTPUT_DIR, slug)
+
+def job_dir(job_id):
+    return os.path.join(JOBS_DIR, str(job_id))
+
+def job_owner_alive(name):
+    """Whether the bot process that made downloads/jobs/<name> is still running"""
+    pid, sep, _ = name.partition("-")
+    # This process has no jobs yet when it cleans up, so its own pid is a leftover of a reused pid
+    if not sep or not pid.isdigit() or int(pid) == os.getpid():
+        return False
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass  # running under another user
+    return True
+
+def chapter_dirs():
+    """Every downloads/<slug>/<chapter> folder"""
+    for slug in os.listdir(OUTPUT_DIR):
+        slug_path = os.path.join(OUTPUT_DIR, slug)
+        if slug_path in (JOBS_DIR, TRASH_DIR) or not os.path.isdir(slug_path):
+            continue
+        for item in os.listdir(slug_path):
+            item_path = os.path.join(slug_path, item)
+            if os.path.isdir(item_path):
+                yield item_path
+
+def remove_empty_series_dirs():
+    for slug in os.listdir(OUTPUT_DIR):
+        slug_path = os.path.join(OUTPUT_DIR, slug)
+        if slug_path not in (JOBS_DIR, TRASH_DIR) and os.path.isdir(slug_path) and not os.listdir(slug_path):
+            os.rmdir(slug_path)
+
+def move_to_trash(path):
+    """Rename path into TRASH_DIR; on the same filesystem this takes no time however big the folder is"""
+    os.makedirs(TRASH_DIR, exist_ok=True)
+    try:
+        os.rename(path, os.path.join(tempfile.mkdtemp(dir=TRASH_DIR), os.path.basename(path)))
+    except OSError:
+        # e.g. path is a mount point of its own; delete it in place instead
+        shutil.rmtree(path, ignore_errors=True)
+
+def empty_trash():
+    started = time.perf_counter()
+    shutil.rmtree(TRASH_DIR, ignore_errors=True)
+    print(f"🗑️ Deleted stale downloads in {time.perf_counter() - started:.1f}s")
+
+# Clean up downloads folder on startup, keeping chapters that can still be resumed.
+# Only renames happen here; the actual deletion (including anything an earlier
+# run left in the trash) runs on a background thread, so a big leftover cache
+# doesn't hold up the bot
 def cleanup_downloads():
     try:
         if os.path.exists(OUTPUT_DIR):
             for item in os.listdir(OUTPUT_DIR):
                 item_path = os.path.join(OUTPUT_DIR, item)
-                if os.path.isdir(item_path):
-                    shutil.rmtree(item_path)
-                elif os.path.isfile(item_path):
+                if os.path.isfile(item_path):
                     os.remove(item_path)
+            if os.path.exists(JOBS_DIR):
+                # Other bot processes on this host may be running jobs in here
+                for name in os.listdir(JOBS_DIR):
+                    if not job_owner_alive(name):
+                        move_to_trash(os.path.join(JOBS_DIR, name))
+            for folder in list(chapter_dirs()):
+                if not is_resumable(folder):
+                    move_to_trash(folder)
+            remove_empty_series_dirs()
+        if os.path.exists(TRASH_DIR):
+            threading.Thread(target=empty_trash, daemon=True, name="empty-trash").start()
         print("🗑️ Cleaned downloads folder on startup")
     except Exception as e:
         print(f"❌ Startup cleanup error: {e}")
 
+# Remove chapter folders left by cancelled or failed jobs once they're too old to resume
+def prune_stale_chapters():
+    removed = 0
+    for folder in list(chapter_dirs()):
+        if chapter_leases.in_use(folder):
+            continue
+        if time.time() - os.path.getmtime(folder) > RESUME_TTL:
+            shutil.rmtree(folder, ignore_errors=True)
+            removed += 1
+    remove_empty_series_dirs()
+    return removed
+
 cleanup_downloads()
 
-bot = telebot.TeleBot(TOKEN)
-user_state = {}
-user_cancel = {}
-autodemo_active = {}  # Track autodemo status for each user
-autodemo_thread = {}  # Track autodemo threads
+class Bot(telebot.TeleBot):
+    def process_new_updates(self, updates):
+        super().process_new_updates(updates)
+        # Webhook mode has run the handlers by now; polling mode has handed them to its workers
+        if updates:
+            metrics.startup_mark("first_update")
+
+# Webhook updates are dispatched by `updates` below, so handlers run inline there
+bot = Bot(TOKEN, threaded=not WEBHOOK_URL)
+# Sessions and flags live in STATE_STORE so every bot process sees the same ones
+store = state_store.open_store()
+user_state = state_store.Sessions(store)
+user_cancel = state_store.Flags(store, "cancel")
+autodemo_active = state_store.Flags(store, "autodemo", ttl=7 * 24 * 3600)  # Track autodemo status for each user
+autodemo_thread = {}  # Track autodemo threads (this process only)
+
+def notify_job_start(job):
+    # Only jobs that had to wait get a "your turn" message
+    if job.position:
+        bot.send_message(job.chat_id, "▶️ Giliran kamu! Download dimulai.")
+
+def cancelled_before_start(job):
+    """Jobs queued before a /cancel, including one handled by another bot process, are dropped"""
+    cancelled_at = user_cancel.get(job.chat_id)
+    return bool(cancelled_at) and cancelled_at >= job.created
+
+scheduler = jobs.JobScheduler(on_start=notify_job_start, is_cancelled=cancelled_before_start)
+metrics.gauge("komiku_jobs_pending", "Download jobs waiting in the queue", scheduler.pending_count)
+metrics.gauge("komiku_jobs_active", "Download jobs running", scheduler.active_count)
+
+# Webhook updates get a scheduler of their own: updates of one chat are handled
+# in order, other chats' replies never wait behind them
+updates = jobs.JobScheduler(workers=UPDATE_WORKERS, wait_stage="update_queue_wait") if WEBHOOK_URL else None
+if updates:
+    metrics.gauge("komiku_updates_pending", "Webhook updates waiting for a handler", updates.pending_count)
 
 def cleanup_resources():
     """Clean up resources to prevent memory issues"""
     try:
-        # Clear old user states (older than 1 hour)
-        current_time = time.time()
-        expired_users = []
-        for chat_id, state in user_state.items():
-            if current_time - state.get('timestamp', current_time) > 3600:  # 1 hour
-                expired_users.append(chat_id)
-        
-        for chat_id in expired_users:
-            user_state.pop(chat_id, None)
-            user_cancel.pop(chat_id, None)
-        
-        # Force garbage collection
-        gc.collect()
-        print(f"🧹 Cleaned up {len(expired_users)} expired user sessions")
+        # Expired sessions and flags; a no-op for stores that expire keys themselves
+        expired = store.purge()
+
+        # Drop expired Telegram file_ids from the result cache
+        result_cache.purge_expired()
+
+        # Drop partial chapters nobody came back for
+        stale_chapters = prune_stale_chapters()
+        if stale_chapters:
+            print(f"🗑️ Removed {stale_chapters} stale chapter folders")
+
+        print(f"🧹 Cleaned up {expired} expired state records")
     except Exception as e:
         print(f"❌ Cleanup error: {e}")
 
@@ -125,11 +270,7 @@ def start_bot_monitor():
                         print("✅ Bot keep-alive successful")
                     except Exception as e:
                         print(f"❌ Bot keep-alive failed: {e}")
-                
-                # Memory cleanup for long-running instances
-                if len(user_state) > 100:  # If too many user states
-                    cleanup_resources()
-                    
+
             except Exception as e:
                 print(f"❌ Bot monitor error: {e}")
     
@@ -139,35 +280,39 @@ def start_bot_monitor():
 
 # -------------------- Fungsi Ambil Data Manga --------------------
 def get_manga_info(manga_url):
-    resp = requests.get(manga_url, headers={"User-Agent": "Mozilla/5.0"})
-    if resp.status_code != 200:
-        return None, None, None
-
-    soup = BeautifulSoup(resp.text, "html.parser")
-    chapter_links = soup.select("a[href*='chapter']")
-    if not chapter_links:
-        return None, None, None
-
-    first_chapter = chapter_links[0]["href"]
-    if not first_chapter.startswith("http"):
-        first_chapter = "https://komiku.org" + first_chapter
-
-    slug = first_chapter.split("-chapter-")[0].replace("https://komiku.org/", "").strip("/")
-    base_url = f"https://komiku.org/{slug}-chapter-{{}}/"
-    manga_name = slug.split("/")[-1]
-
-    chapter_numbers = set()
-    for link in chapter_links:
-        href = link["href"]
-        if "-chapter-" in href:
-            try:
-                num = int(href.split("-chapter-")[-1].replace("/", "").split("?")[0])
-                chapter_numbers.add(num)
-            except:
-                pass
-    total_chapters = max(chapter_numbers) if chapter_numbers else None
+    """Return (base_url, manga_name, total_chapters, chapters) where chapters is a sorted [(number, url)] list"""
+    chapters = metadata.get_chapters(manga_url)
+    if not chapters:
+        return None, None, None, None
+
+    first_chapter = chapters[0][1]
+    base_url = first_chapter.split("-chapter-")[0] + "-chapter-{}/"
+    manga_name = metadata.get_slug(first_chapter.split("-chapter-")[0])
+    total_chapters = chapters[-1][0]
 
-    return base_url, manga_name, total_chapters
+    return base_url, manga_name, total_chapters, chapters
+
+def parse_chapter_number(text):
+    """Parse a chapter typed by the user ("12" or "10.5"); None when it isn't a number"""
+    try:
+        number = float(text)
+    except ValueError:
+        return None
+    if number < 0 or number != number:  # reject negatives and NaN
+        return None
+    return int(number) if number.is_integer() else number
+
+def quota_message(chat_id, wait):
+    remaining = rate_limit.chapter_quota.remaining(chat_id)
+    return (
+        f"⏳ Batas {rate_limit.chapter_quota.limit} chapter per jam tercapai (sisa {remaining} chapter). "
+        f"Coba lagi dalam {rate_limit.describe_wait(wait)}."
+    )
+
+def select_chapters(state):
+    """[(number, url)] of the series chapters between awal and akhir"""
+    awal, akhir = state["awal"], state["akhir"]
+    return [(num, url) for num, url in state["chapters"] if awal <= num <= akhir]
 
 # -------------------- Handler /start --------------------
 @bot.message_handler(commands=['start'])
@@ -190,7 +335,7 @@ def start(message):
 @bot.message_handler(commands=['manga'])
 def manga_mode(message):
     chat_id = message.chat.id
-    user_state[chat_id] = {"step": "link", "mode": "normal", "timestamp": time.time()}
+    user_state.put(chat_id, {"step": "link", "mode": "normal"})
     tutorial = (
         "📖 Mode Normal aktif! Download manga dari Komiku 📚\n\n"
         "Cara pakai:\n"
@@ -198,8 +343,9 @@ def manga_mode(message):
         "   Contoh: https://komiku.org/manga/mairimashita-iruma-kun/\n"
         "2️⃣ Masukkan nomor chapter awal\n"
         "3️⃣ Masukkan nomor chapter akhir\n"
-        "4️⃣ Pilih mau di-GABUNG jadi 1 PDF atau di-PISAH per chapter\n\n"
+        "4️⃣ Pilih mau di-GABUNG jadi 1 file atau di-PISAH per chapter, dalam PDF atau CBZ\n\n"
         "📌 Bot akan download dan kirim sesuai pilihan kamu.\n\n"
+        f"⚠️ BATASAN: Maksimal {rate_limit.MAX_CHAPTERS_NORMAL} chapter per download, {rate_limit.CHAPTERS_PER_HOUR} chapter per jam\n"
         "⚠️ Bisa hentikan download kapan saja dengan /cancel"
     )
     bot.reply_to(message, tutorial)
@@ -225,35 +371,25 @@ def handle_mode_selection(call):
 def cancel_download(message):
     chat_id = message.chat.id
     user_cancel[chat_id] = True
+    # Drop queued jobs and stop the running one. Pages already downloaded stay on
+    # disk (with their manifest) so asking for the same chapters again resumes
+    scheduler.cancel(chat_id)
     
-    # Clean up any existing downloads immediately
-    cleanup_user_downloads(chat_id)
-    
-    bot.reply_to(message, "⛔ Download dihentikan! Semua file telah dihapus.")
+    bot.reply_to(message, "⛔ Download dihentikan! Kirim permintaan yang sama lagi untuk melanjutkan dari halaman terakhir.")
 
-def cleanup_user_downloads(chat_id):
-    """Clean up all download files and folders for a specific user"""
+def cleanup_user_downloads(chat_id, state=None, owner=None, remove=True):
+    """Release a job's leases on its chapter folders; a folder is deleted once no other job uses it
+
+    With remove=False (cancelled or failed jobs) the folders stay so the same
+    request can resume from the pages already on disk.
+    """
     try:
-        if chat_id in user_state:
-            manga_name = user_state[chat_id].get("manga_name", "")
-            awal = user_state[chat_id].get("awal", 0)
-            akhir = user_state[chat_id].get("akhir", 0)
-            download_mode = user_state[chat_id].get("mode", "normal")
-            
-            # Remove chapter folders
-            for ch in range(awal, akhir + 1):
-                if download_mode == "big":
-                    folder_ch = os.path.join(OUTPUT_DIR, f"chapter-{ch}-big")
-                else:
-                    folder_ch = os.path.join(OUTPUT_DIR, f"chapter-{ch}")
-                    
-                if os.path.exists(folder_ch):
-                    shutil.rmtree(folder_ch)
-                    print(f"🗑️ Deleted folder: {folder_ch}")
-            
-            # Only remove temporary chapter folders, keep PDF files for user
-            # PDF files will be cleaned up during startup cleanup only
-        
+        state = state or user_state.get(chat_id)
+        if state and "akhir" in state and owner is not None:
+            big = state.get("mode", "normal") == "big"
+            for ch, _ in select_chapters(state):
+                chapter_leases.release(get_chapter_folder(series_dir(state["manga_name"]), ch, big), owner, remove)
+
         print(f"🧹 Cleanup completed for user {chat_id}")
     except Exception as e:
         print(f"❌ Cleanup error for user {chat_id}: {e}")
@@ -262,7 +398,7 @@ def cleanup_user_downloads(chat_id):
 @bot.message_handler(commands=['komik'])
 def komik_mode(message):
     chat_id = message.chat.id
-    user_state[chat_id] = {"step": "link", "mode": "big", "timestamp": time.time()}
+    user_state.put(chat_id, {"step": "link", "mode": "big"})
     tutorial = (
         "🔥 Mode Komik aktif! Download gambar yang lebih panjang\n\n"
         "Cara pakai:\n"
@@ -270,9 +406,9 @@ def komik_mode(message):
         "   Contoh: https://komiku.org/manga/mairimashita-iruma-kun/\n"
         "2️⃣ Masukkan nomor chapter awal\n"
         "3️⃣ Masukkan nomor chapter akhir\n"
-        "4️⃣ Pilih mau di-GABUNG jadi 1 PDF atau di-PISAH per chapter\n\n"
+        "4️⃣ Pilih mau di-GABUNG jadi 1 file atau di-PISAH per chapter, dalam PDF atau CBZ\n\n"
         "📌 Mode ini akan download gambar dengan resolusi lebih tinggi.\n"
-        "⚠️ BATASAN: Maksimal 3 chapter per download\n"
+        f"⚠️ BATASAN: Maksimal {rate_limit.MAX_CHAPTERS_BIG} chapter per download\n"
         "⚠️ Bisa hentikan download kapan saja dengan /cancel"
     )
     bot.reply_to(message, tutorial)
@@ -282,7 +418,7 @@ def komik_mode(message):
 def start_autodemo(message):
     chat_id = message.chat.id
     
-    if chat_id in autodemo_active and autodemo_active[chat_id]:
+    if autodemo_active.get(chat_id):
         bot.reply_to(message, "🤖 Auto demo sudah aktif! Gunakan /offautodemo untuk menghentikan.")
         return
     
@@ -310,7 +446,7 @@ def start_autodemo(message):
                 
                 # Send /manga command
                 bot.send_message(chat_id, "🤖 Auto Demo: Memulai mode /manga")
-                user_state[chat_id] = {"step": "link", "mode": "normal", "timestamp": time.time()}
+                user_state.put(chat_id, {"step": "link", "mode": "normal"})
                 
                 time.sleep(2)
                 
@@ -319,80 +455,103 @@ def start_autodemo(message):
                 bot.send_message(chat_id, f"🤖 Auto Demo: Mengirim link\n{manga_url}")
                 
                 # Process the manga URL
-                base_url, manga_name, total_chapters = get_manga_info(manga_url)
+                base_url, manga_name, total_chapters, chapters = get_manga_info(manga_url)
                 if base_url:
-                    user_state[chat_id].update({
-                        "base_url": base_url,
-                        "manga_name": manga_name,
-                        "total_chapters": total_chapters,
-                        "step": "awal"
-                    })
+                    user_state.update(
+                        chat_id,
+                        base_url=base_url,
+                        manga_name=manga_name,
+                        total_chapters=total_chapters,
+                        chapters=chapters,
+                        step="awal",
+                    )
                     
                     time.sleep(2)
                     
                     # Send chapter start
                     bot.send_message(chat_id, f"🤖 Auto Demo: Chapter awal: {chapter_start}")
-                    user_state[chat_id]["awal"] = chapter_start
-                    user_state[chat_id]["step"] = "akhir"
+                    user_state.update(chat_id, awal=chapter_start, step="akhir")
                     
                     time.sleep(2)
                     
                     # Send chapter end (max 5 chapters ahead)
                     chapter_end = min(chapter_start + 4, total_chapters, chapter_start + 2)  # Limit to 3 chapters max
                     bot.send_message(chat_id, f"🤖 Auto Demo: Chapter akhir: {chapter_end}")
-                    user_state[chat_id]["akhir"] = chapter_end
-                    user_state[chat_id]["step"] = "mode"
+                    user_state.update(chat_id, akhir=chapter_end, step="mode")
                     
                     time.sleep(2)
                     
                     # Auto select "pisah" mode
                     bot.send_message(chat_id, "🤖 Auto Demo: Memilih mode PISAH per chapter")
                     
-                    # Start download process
-                    try:
-                        user_cancel[chat_id] = False
-                        base_url_format = user_state[chat_id]["base_url"]
-                        manga_name_demo = user_state[chat_id]["manga_name"]
-                        awal = user_state[chat_id]["awal"]
-                        akhir = user_state[chat_id]["akhir"]
+                    # Start download process on the job workers, behind real users' jobs
+                    demo_state = user_state.get(chat_id)
+                    if demo_state is None:
+                        break  # stopped with /offautodemo meanwhile
+
+                    # The demo counts against the chat's hourly quota like any user request
+                    demo_chapters = len(select_chapters(demo_state))
+                    wait = rate_limit.chapter_quota.check(chat_id, demo_chapters)
+                    if wait:
+                        bot.send_message(chat_id, f"🤖 Auto Demo: Kuota chapter per jam habis, menunggu {rate_limit.describe_wait(wait)}...")
+                        for _ in range(wait):
+                            if not autodemo_active.get(chat_id, False):
+                                break
+                            time.sleep(1)
+                        continue
+                    rate_limit.chapter_quota.record(chat_id, demo_chapters)
+
+                    def demo_download(job):
+                        cancel = jobs.JobCancel(job, user_cancel)
+                        try:
+                            user_cancel[chat_id] = False
+                            manga_name_demo = demo_state["manga_name"]
+                            awal = demo_state["awal"]
+                            akhir = demo_state["akhir"]
                         
-                        bot.send_message(chat_id, f"🤖 Auto Demo: Memulai download chapter {awal} s/d {akhir}...")
+                            bot.send_message(chat_id, f"🤖 Auto Demo: Memulai download chapter {awal} s/d {akhir}...")
                         
-                        # Download in pisah mode
-                        for ch in range(awal, akhir + 1):
-                            if not autodemo_active.get(chat_id, False) or user_cancel.get(chat_id):
-                                break
+                            # Download in pisah mode
+                            for ch, chapter_url in select_chapters(demo_state):
+                                if not autodemo_active.get(chat_id, False) or cancel.get(chat_id):
+                                    break
                                 
-                            bot.send_message(chat_id, f"🤖 Auto Demo: Download chapter {ch}...")
+                                pdf_name = f"{manga_name_demo} chapter {ch}.pdf"
+                                cache_key = result_cache.make_key(manga_name_demo, ch, "normal", "pisah")
+                                if send_cached(chat_id, cache_key, f"🤖 Auto Demo: {pdf_name}"):
+                                    continue
+
+                                bot.send_message(chat_id, f"🤖 Auto Demo: Download chapter {ch}...")
                             
-                            imgs = download_chapter(base_url_format.format(ch), ch, OUTPUT_DIR, chat_id, user_cancel)
+                                chapter_root = series_dir(manga_name_demo)
+                                _, imgs = next(download_chapters([(ch, chapter_url)], chapter_root, chat_id, cancel, False, jobs.chapter_slots, job.id), (ch, []))
                             
-                            if imgs and not user_cancel.get(chat_id):
-                                pdf_name = f"{manga_name_demo} chapter {ch}.pdf"
-                                pdf_path = os.path.join(OUTPUT_DIR, pdf_name)
-                                create_pdf(imgs, pdf_path)
-                                
-                                try:
-                                    with open(pdf_path, "rb") as pdf_file:
-                                        bot.send_document(chat_id, pdf_file, caption=f"🤖 Auto Demo: {pdf_name}")
-                                    print(f"✅ Auto Demo PDF sent: {pdf_name}")
-                                    # Auto-delete PDF after 10 seconds
-                                    auto_delete_pdf(pdf_path, 10)
-                                except Exception as upload_error:
-                                    print(f"❌ Auto Demo upload error: {upload_error}")
-                                    bot.send_message(chat_id, f"🤖 Auto Demo: Gagal upload {pdf_name}")
-                                    # Still delete even if upload failed
-                                    auto_delete_pdf(pdf_path, 10)
+                                if imgs and not cancel.get(chat_id):
+                                    try:
+                                        # The PDF is deleted once its upload is over, even if it failed
+                                        work_dir = job_dir(job.id)
+                                        # A chapter that lost pages is sent but not cached
+                                        with metrics.labels(slug=manga_name_demo, chapter=ch):
+                                            deliver_pdf(chat_id, layout_pages(imgs, out_dir=work_dir), pdf_name, work_dir, cache_key if is_complete(imgs) else None, "🤖 Auto Demo: ")
+                                    except Exception as upload_error:
+                                        print(f"❌ Auto Demo upload error: {upload_error}")
+                                        bot.send_message(chat_id, f"🤖 Auto Demo: Gagal upload {pdf_name}")
                                 
-                                folder_ch = os.path.join(OUTPUT_DIR, f"chapter-{ch}")
-                                if os.path.exists(folder_ch):
-                                    shutil.rmtree(folder_ch)
+                                chapter_leases.release(get_chapter_folder(chapter_root, ch), job.id, remove=not cancel.get(chat_id))
                         
-                        if autodemo_active.get(chat_id, False):
-                            bot.send_message(chat_id, "🤖 Auto Demo: Selesai! Menunggu demo berikutnya...")
+                            if autodemo_active.get(chat_id, False):
+                                bot.send_message(chat_id, "🤖 Auto Demo: Selesai! Menunggu demo berikutnya...")
                         
-                    except Exception as e:
-                        bot.send_message(chat_id, f"🤖 Auto Demo Error: {e}")
+                        except Exception as e:
+                            bot.send_message(chat_id, f"🤖 Auto Demo Error: {e}")
+                        finally:
+                            # Leases still held after an error or cancel; their folders stay for resume
+                            cleanup_user_downloads(chat_id, demo_state, job.id, remove=False)
+                            shutil.rmtree(job_dir(job.id), ignore_errors=True)
+
+                    demo_job = jobs.Job(chat_id, demo_download, priority=jobs.PRIORITY_DEMO, label="autodemo")
+                    scheduler.submit(demo_job)
+                    demo_job.done.wait()
                 
                 # Prepare for next demo
                 current_url += 1
@@ -424,17 +583,19 @@ def start_autodemo(message):
 def stop_autodemo(message):
     chat_id = message.chat.id
     
-    if chat_id not in autodemo_active or not autodemo_active[chat_id]:
+    if not autodemo_active.get(chat_id):
         bot.reply_to(message, "🤖 Auto demo tidak aktif.")
         return
     
-    # Stop autodemo
+    # Stop autodemo: drop a queued demo job and stop the running one. The
+    # cancel flag stays set until the autodemo loop exits, so a demo job
+    # running in another bot process stops too
     autodemo_active[chat_id] = False
     user_cancel[chat_id] = True
+    scheduler.cancel(chat_id)
     
     # Clean up user state
     user_state.pop(chat_id, None)
-    user_cancel.pop(chat_id, None)
     
     # Clean up any ongoing downloads
     cleanup_user_downloads(chat_id)
@@ -447,46 +608,391 @@ def handle_message(message):
     chat_id = message.chat.id
     text = message.text.strip()
 
-    if chat_id not in user_state:
+    state = user_state.get(chat_id)
+    if state is None:
         bot.reply_to(message, "Ketik /start dulu ya.")
         return
 
-    step = user_state[chat_id]["step"]
+    step = state["step"]
 
     if step == "link":
         if not text.startswith("https://komiku.org/manga/"):
             bot.reply_to(message, "❌ Link tidak valid! Contoh:\nhttps://komiku.org/manga/mairimashita-iruma-kun/")
             return
 
-        base_url, manga_name, total_chapters = get_manga_info(text)
+        base_url, manga_name, total_chapters, chapters = get_manga_info(text)
         if not base_url:
             bot.reply_to(message, "❌ Gagal mengambil data manga. Pastikan link benar.")
             return
 
-        user_state[chat_id].update({
+        state.update({
             "base_url": base_url,
             "manga_name": manga_name,
-            "total_chapters": total_chapters
+            "total_chapters": total_chapters,
+            "chapters": chapters,
+            # Read from the page get_manga_info just cached, for CBZ ComicInfo.xml
+            "series_info": metadata.get_series_info(text)
         })
 
-        user_state[chat_id]["step"] = "awal"
-        bot.reply_to(message, f"📌 Masukkan chapter awal (1 - {total_chapters}):")
+        state["step"] = "awal"
+        user_state.put(chat_id, state)
+        bot.reply_to(message, f"📌 Masukkan chapter awal ({chapters[0][0]} - {total_chapters}):")
 
     elif step == "awal":
-        if not text.isdigit():
+        awal = parse_chapter_number(text)
+        if awal is None:
             bot.reply_to(message, "❌ Harap masukkan angka untuk chapter awal.")
             return
-        user_state[chat_id]["awal"] = int(text)
-        user_state[chat_id]["step"] = "akhir"
-        bot.reply_to(message, f"📌 Masukkan chapter akhir (maks {user_state[chat_id]['total_chapters']}):")
+        user_state.update(chat_id, awal=awal, step="akhir")
+        bot.reply_to(message, f"📌 Masukkan chapter akhir (maks {state['total_chapters']}):")
 
     elif step == "akhir":
-        if not text.isdigit():
+        akhir = parse_chapter_number(text)
+        if akhir is None:
             bot.reply_to(message, "❌ Harap masukkan angka untuk chapter akhir.")
             return
-        awal = user_state[chat_id]["awal"]
-        akhir = int(text)
-        total = user_state[chat_id]['total_chapters']
-        download_mode = user_state[chat_id].get("mode", "normal")
+        awal = state["awal"]
+        total = state['total_chapters']
+        download_mode = state.get("mode", "normal")
         
-        if ak
\ No newline at end of file
+        if akhir < awal or (total and akhir > total):
+            bot.reply_to(message, f"❌ Chapter akhir harus antara {awal} - {total}.")
+            return
+        selected = select_chapters({**state, "akhir": akhir})
+        if not selected:
+            bot.reply_to(message, "❌ Tidak ada chapter di rentang itu. Masukkan chapter akhir lagi:")
+            return
+        limit = rate_limit.max_chapters(download_mode)
+        if len(selected) > limit:
+            bot.reply_to(message, f"⚠️ Maksimal {limit} chapter per download di mode ini. Masukkan chapter akhir lagi:")
+            return
+        wait = rate_limit.chapter_quota.check(chat_id, len(selected))
+        if wait:
+            bot.reply_to(message, quota_message(chat_id, wait) + "\nMasukkan chapter akhir lagi untuk rentang yang lebih kecil:")
+            return
+
+        user_state.update(chat_id, akhir=akhir, step="mode")
+
+        markup = types.InlineKeyboardMarkup()
+        btn_gabung = types.InlineKeyboardButton("📚 GABUNG jadi 1 PDF", callback_data="gabung")
+        btn_pisah = types.InlineKeyboardButton("📄 PISAH per chapter", callback_data="pisah")
+        btn_gabung_cbz = types.InlineKeyboardButton("🗂️ GABUNG jadi 1 CBZ", callback_data="gabung_cbz")
+        btn_pisah_cbz = types.InlineKeyboardButton("🗃️ PISAH per chapter (CBZ)", callback_data="pisah_cbz")
+        markup.add(btn_gabung)
+        markup.add(btn_pisah)
+        markup.add(btn_gabung_cbz, btn_pisah_cbz)
+        bot.reply_to(message, "📦 Mau di-GABUNG jadi 1 file atau di-PISAH per chapter? Pilih PDF atau CBZ.", reply_markup=markup)
+
+    elif step == "mode":
+        bot.reply_to(message, "👆 Pilih GABUNG atau PISAH lewat tombol di atas.")
+
+# -------------------- Handler Pilihan GABUNG / PISAH --------------------
+@bot.callback_query_handler(func=lambda call: call.data in ["gabung", "pisah", "gabung_cbz", "pisah_cbz"])
+def handle_merge_choice(call):
+    chat_id = call.message.chat.id
+
+    # Remove the inline keyboard buttons
+    try:
+        bot.edit_message_reply_markup(chat_id, call.message.message_id, reply_markup=None)
+    except:
+        pass
+
+    state = user_state.get(chat_id)
+    if state is None or state.get("step") != "mode":
+        bot.send_message(chat_id, "Ketik /start dulu ya.")
+        return
+
+    # Checked again: another request from this chat may have used the quota meanwhile
+    requested = len(select_chapters(state))
+    wait = rate_limit.chapter_quota.check(chat_id, requested)
+    if wait:
+        user_state.pop(chat_id)
+        bot.send_message(chat_id, quota_message(chat_id, wait))
+        return
+    rate_limit.chapter_quota.record(chat_id, requested)
+
+    # The job keeps its own copy of the request so the chat can start a new one while it waits
+    user_state.pop(chat_id)
+    merge_mode, _, output_format = call.data.partition("_")
+    state["format"] = output_format or "pdf"
+
+    def download_job(job):
+        finished = False
+        cancel = jobs.JobCancel(job, user_cancel)
+        try:
+            with metrics.labels(slug=state["manga_name"]):
+                run_download(chat_id, state, merge_mode, job.id, cancel)
+            finished = not cancel.get(chat_id)
+        except Exception as e:
+            print(f"❌ Download error for user {chat_id}: {e}")
+            bot.send_message(chat_id, f"❌ Terjadi kesalahan: {e}\nKirim permintaan yang sama lagi untuk melanjutkan.")
+        finally:
+            # Chapter folders of failed or cancelled jobs are kept so a retry resumes from the pages on disk
+            cleanup_user_downloads(chat_id, state, job.id, remove=finished)
+            # Every upload of the job is over by now; what is left are layout pages and unsent parts
+            shutil.rmtree(job_dir(job.id), ignore_errors=True)
+
+    job = jobs.Job(chat_id, download_job, label=f"{state['manga_name']} {state['awal']}-{state['akhir']}")
+    position = scheduler.submit(job)
+    if position:
+        bot.send_message(chat_id, f"🕒 Download kamu masuk antrean ke-{position}. Ketik /cancel untuk membatalkan.")
+
+def part_name(name, part, parts):
+    if parts == 1:
+        return name
+    stem, ext = os.path.splitext(name)
+    return f"{stem} part {part}{ext}"
+
+def remember_upload(doc):
+    # Remember the uploaded file(s) so the next identical request is just a re-send.
+    # Re-sends aren't stored again, so entries still expire RESULT_CACHE_TTL after the upload
+    if doc.cache_key and not doc.cached and all(doc.file_ids):
+        result_cache.put(doc.cache_key, "\n".join(doc.file_ids))
+
+def open_uploads(chat_id, cancel):
+    """Background upload stage for a job's documents; close() it before reporting the job done"""
+
+    def failed(doc, error):
+        # A rejected re-send is rebuilt by the job instead (see send_cached)
+        if not doc.cached:
+            bot.send_message(chat_id, f"❌ Gagal upload {doc.name}")
+
+    return uploader.UploadQueue(TOKEN, chat_id, remember_upload, failed, lambda: cancel.get(chat_id))
+
+def send_parts(chat_id, paths, cache_key=None, caption_prefix="", uploads=None, name=None):
+    """Send the finished file(s) of one document, deleting each file once it is uploaded
+
+    With an uploads queue the document is queued and this returns at once;
+    otherwise it is uploaded here and upload errors are raised.
+    """
+    doc = uploader.Document(paths, [caption_prefix + os.path.basename(path) for path in paths], cache_key, name)
+    if uploads:
+        uploads.submit(doc)
+        return
+    uploader.upload(TOKEN, chat_id, doc)
+    remember_upload(doc)
+
+def deliver_pdf(chat_id, images, pdf_name, work_dir, cache_key=None, caption_prefix="", uploads=None):
+    """Build and send a PDF in work_dir, split into numbered parts when it won't fit Telegram's upload cap"""
+    os.makedirs(work_dir, exist_ok=True)
+    parts = size_budget.fit_pages(images, out_dir=work_dir)
+    paths = []
+    for part, part_images in enumerate(parts, start=1):
+        pdf_path = os.path.join(work_dir, part_name(pdf_name, part, len(parts)))
+        create_pdf(part_images, pdf_path)
+        paths.append(pdf_path)
+    send_parts(chat_id, paths, cache_key, caption_prefix, uploads, pdf_name)
+
+def open_archive(cbz_name, work_dir, state, title, number=None):
+    """CBZ output for a request; Telegram's upload cap applies to archives just like PDFs"""
+    os.makedirs(work_dir, exist_ok=True)
+    return CbzParts(
+        os.path.join(work_dir, cbz_name),
+        size_budget.PDF_SIZE_BUDGET,
+        state.get("series_info", {}),
+        title,
+        number,
+    )
+
+def send_cached(chat_id, cache_key, caption, cached=None, uploads=None):
+    """Re-send a previously uploaded document (every part of it) by file_id; returns False when it has to be built
+
+    cached is the result_cache entry when the caller already looked it up.
+    With an uploads queue the re-send waits its turn behind the documents
+    queued before it, so it can't reach the chat ahead of them.
+    """
+    if cached is None:
+        cached = result_cache.get(cache_key)
+        metrics.cache_requests.inc(cache="result", result="hit" if cached else "miss")
+    if not cached:
+        return False
+    file_ids = cached.split("\n")
+    captions = [part_name(caption, part, len(file_ids)) for part in range(1, len(file_ids) + 1)]
+    try:
+        if uploads:
+            doc = uploader.Document([], captions, cache_key, caption, file_ids=file_ids)
+            uploads.submit(doc)
+            doc.done.wait()
+            if doc.error:
+                raise doc.error
+        else:
+            for file_id, part_caption in zip(file_ids, captions):
+                bot.send_document(chat_id, file_id, caption=part_caption)
+        print(f"♻️ Re-sent from cache: {cache_key}")
+        return True
+    except Exception as e:
+        # The file_id is no longer usable; forget it and rebuild
+        print(f"⚠️ Cached file_id rejected for {cache_key}: {e}")
+        result_cache.invalidate(cache_key)
+        return False
+
+def run_download(chat_id, state, merge_mode, job_id, cancel):
+    """Run one download request; cancel is the job's user_cancel-style check (jobs.JobCancel)"""
+    user_cancel[chat_id] = False
+    chapters = select_chapters(state)
+    manga_name = state["manga_name"]
+    chapter_root = series_dir(manga_name)
+    work_dir = job_dir(job_id)
+    awal = state["awal"]
+    akhir = state["akhir"]
+    download_mode = state.get("mode", "normal")
+    output_format = state.get("format", "pdf")
+    big = download_mode == "big"
+
+    bot.send_message(chat_id, f"⏳ Mulai download chapter {awal} s/d {akhir}...")
+
+    if merge_mode == "gabung":
+        doc_name = f"{manga_name} chapter {awal}-{akhir}.{output_format}"
+        cache_key = result_cache.make_key(manga_name, (awal, akhir), download_mode, merge_mode, output_format)
+        if send_cached(chat_id, cache_key, doc_name):
+            bot.send_message(chat_id, "✅ Selesai! Ketik /manga atau /komik untuk download lagi.")
+            return
+
+        # CBZ pages go into the archive as each chapter arrives; PDF pages are laid out first
+        archive = open_archive(doc_name, work_dir, state, f"Chapter {awal}-{akhir}") if output_format == "cbz" else None
+        all_images = []
+        page_count = 0
+        complete = True
+        try:
+            for ch, imgs in download_chapters(chapters, chapter_root, chat_id, cancel, big, jobs.chapter_slots, job_id):
+                bot.send_message(chat_id, f"📥 Chapter {ch} selesai di-download ({len(imgs)} halaman)")
+                page_count += len(imgs)
+                complete = complete and is_complete(imgs)
+                if archive:
+                    archive.add_images(imgs)
+                else:
+                    # Laid out per chapter so stitching never joins pages of two chapters
+                    all_images.extend(layout_pages(imgs, out_dir=work_dir))
+
+            if cancel.get(chat_id):
+                return
+            if not page_count:
+                bot.send_message(chat_id, "❌ Tidak ada gambar yang berhasil di-download.")
+                return
+
+            # A document missing chapters or pages is sent, but not cached under the full range
+            if not complete:
+                cache_key = None
+            try:
+                if archive:
+                    send_parts(chat_id, archive.close(), cache_key, name=doc_name)
+                else:
+                    deliver_pdf(chat_id, all_images, doc_name, work_dir, cache_key)
+            except Exception as upload_error:
+                print(f"❌ Upload error: {upload_error}")
+                bot.send_message(chat_id, f"❌ Gagal upload {doc_name}")
+        finally:
+            if archive:
+                archive.discard()
+    else:
+        # Chapters already delivered once are re-sent by file_id; the rest download
+        # ahead in the background while the current one is built, and finished
+        # documents upload in the background while the next one is built
+        cache_keys = {ch: result_cache.make_key(manga_name, ch, download_mode, merge_mode, output_format) for ch, _ in chapters}
+        cached = {ch: result_cache.get(cache_keys[ch]) for ch, _ in chapters}
+        for file_ids in cached.values():
+            metrics.cache_requests.inc(cache="result", result="hit" if file_ids else "miss")
+        to_download = [(ch, url) for ch, url in chapters if not cached[ch]]
+        downloads = download_chapters(to_download, chapter_root, chat_id, cancel, big, jobs.chapter_slots, job_id)
+        queued = {ch for ch, _ in to_download}
+        uploads = open_uploads(chat_id, cancel)
+
+        try:
+            for ch, chapter_url in chapters:
+                if cancel.get(chat_id):
+                    return
+                doc_name = f"{manga_name} chapter {ch}.{output_format}"
+                cache_key = cache_keys[ch]
+                if ch in queued:
+                    _, imgs = next(downloads, (ch, []))
+                elif send_cached(chat_id, cache_key, doc_name, cached[ch], uploads):
+                    continue
+                else:
+                    # The cached file_id was rejected; download this chapter on its own
+                    _, imgs = next(download_chapters([(ch, chapter_url)], chapter_root, chat_id, cancel, big, jobs.chapter_slots, job_id), (ch, []))
+                if cancel.get(chat_id):
+                    return
+                if not imgs:
+                    # Queued, so it follows the chapters before it
+                    uploads.submit(uploader.Notice(f"❌ Chapter {ch} gagal di-download."))
+                    continue
+                if not is_complete(imgs):
+                    cache_key = None
+
+                try:
+                    with metrics.labels(chapter=ch):
+                        if output_format == "cbz":
+                            archive = open_archive(doc_name, work_dir, state, f"Chapter {ch}", ch)
+                            try:
+                                archive.add_images(imgs)
+                                send_parts(chat_id, archive.close(), cache_key, uploads=uploads, name=doc_name)
+                            finally:
+                                archive.discard()
+                        else:
+                            deliver_pdf(chat_id, layout_pages(imgs, out_dir=work_dir), doc_name, work_dir, cache_key, uploads=uploads)
+                except Exception as build_error:
+                    print(f"❌ Build error: {build_error}")
+                    uploads.submit(uploader.Notice(f"❌ Gagal membuat {doc_name}"))
+
+                # The document is built; the chapter's pages are no longer needed
+                chapter_leases.release(get_chapter_folder(chapter_root, ch, big), job_id)
+        finally:
+            uploads.close()
+
+    bot.send_message(chat_id, "✅ Selesai! Ketik /manga atau /komik untuk download lagi.")
+
+# -------------------- Webhook --------------------
+def update_chat_id(update):
+    """Chat an update belongs to; updates without one are handled independently"""
+    message = update.message or update.edited_message
+    if update.callback_query:
+        message = update.callback_query.message
+    return message.chat.id if message else ("update", update.update_id)
+
+def queue_update(data):
+    """Called by the webhook route; hands the update to a worker and returns right away"""
+    update = types.Update.de_json(data)
+
+    def handle(job):
+        with metrics.span("update_handle"):
+            bot.process_new_updates([update])
+
+    updates.submit(jobs.Job(update_chat_id(update), handle, label="update"))
+
+def start_webhook():
+    """Serve the webhook route and point Telegram at it; returns the server thread"""
+    from keep_alive import add_webhook, keep_alive
+    add_webhook(WEBHOOK_PATH, WEBHOOK_SECRET, queue_update)
+    server = keep_alive()
+    bot.set_webhook(url=WEBHOOK_URL + WEBHOOK_PATH, secret_token=WEBHOOK_SECRET)
+    print(f"🔗 Webhook set: {WEBHOOK_URL}{WEBHOOK_PATH}")
+    return server
+
+def start_keep_alive():
+    # Flask is imported on the server's own thread, so polling starts without waiting for it
+    def serve():
+        from keep_alive import run
+        run()
+
+    server_thread = threading.Thread(target=serve)
+    server_thread.daemon = True
+    server_thread.start()
+
+if __name__ == "__main__":
+    if WEBHOOK_URL:
+        # Telegram's pushes keep the bot and the server alive; no ping threads needed
+        server = start_webhook()
+        start_cleanup_scheduler()
+        metrics.startup_mark("ready")
+        print("🤖 Bot berjalan (webhook)...")
+        server.join()
+    else:
+        start_keep_alive()
+        start_cleanup_scheduler()
+        start_auto_ping()
+        start_bot_monitor()
+        print("🤖 Bot berjalan...")
+        # getUpdates is refused while a webhook from an earlier webhook-mode run is set
+        bot.remove_webhook()
+        metrics.startup_mark("ready")
+        bot.infinity_polling(timeout=60, long_polling_timeout=30)
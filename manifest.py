@@ -0,0 +1,70 @@
+# manifest.py
+# Per-chapter record of which pages are already on disk, so a chapter that was
+# interrupted (bot restart, /cancel, network hiccup) picks up where it stopped
+# instead of starting from zero. Saved as manifest.json inside the chapter
+# folder after every page, via a temp file + os.replace.
+import hashlib
+import json
+import os
+import threading
+import time
+
+MANIFEST_NAME = "manifest.json"
+
+def _sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def has_manifest(folder):
+    return os.path.exists(os.path.join(folder, MANIFEST_NAME))
+
+class ChapterManifest:
+    """Page status (url, size, sha256, done/failed) of one chapter folder"""
+
+    def __init__(self, folder, chapter_url):
+        self.path = os.path.join(folder, MANIFEST_NAME)
+        self.lock = threading.Lock()
+        data = None
+        try:
+            with open(self.path) as f:
+                data = json.load(f)
+        except (FileNotFoundError, ValueError):
+            pass
+        # A manifest written for a different chapter URL is stale; start over
+        if not data or data.get("chapter_url") != chapter_url:
+            data = {"chapter_url": chapter_url, "pages": {}}
+        self.data = data
+
+    def is_done(self, index, url, img_path):
+        """True when the page was finished before and its file is still intact on disk"""
+        entry = self.data["pages"].get(str(index))
+        if not entry or entry["status"] != "done" or entry["url"] != url:
+            return False
+        try:
+            # Size first: it's free and catches truncated files without hashing them
+            return os.path.getsize(img_path) == entry["size"] and _sha256_file(img_path) == entry.get("sha256")
+        except OSError:
+            return False
+
+    def mark_done(self, index, url, img_path):
+        self._set(index, {
+            "url": url,
+            "status": "done",
+            "size": os.path.getsize(img_path),
+            "sha256": _sha256_file(img_path),
+        })
+
+    def mark_failed(self, index, url, error):
+        self._set(index, {"url": url, "status": "failed", "error": str(error)})
+
+    def _set(self, index, entry):
+        with self.lock:
+            self.data["pages"][str(index)] = entry
+            self.data["updated"] = time.time()
+            tmp_path = self.path + ".tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.data, f)
+            os.replace(tmp_path, self.path)
@@ -0,0 +1,169 @@
+# metadata.py
+# Series page lookups. The chapter list is pulled out of the raw HTML with a
+# targeted regex over the chapter table's hrefs instead of building a full soup
+# tree, and results are cached per slug (the METADATA_CACHE_SIZE most recently
+# used series). Once METADATA_TTL has passed the page is revalidated with
+# ETag / Last-Modified, so an unchanged series costs a 304.
+# The same pass picks up the series details (title, author, genres, synopsis)
+# used for CBZ ComicInfo.xml.
+import html as htmllib
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+from urllib.parse import urljoin, urlparse
+import http_client
+import metrics
+
+METADATA_TTL = int(os.getenv("METADATA_TTL", "600"))
+METADATA_CACHE_SIZE = int(os.getenv("METADATA_CACHE_SIZE", "256"))
+
+# Matches .../<slug>-chapter-12/, -chapter-10.5/ and komiku's -chapter-10-5/ style
+CHAPTER_HREF_RE = re.compile(
+    r"""href\s*=\s*["']([^"']*?-chapter-(\d+)(?:[.-](\d+))?/?(?:[?#][^"']*)?)["']""",
+    re.IGNORECASE,
+)
+
+# The element holding a series page's chapter table
+CHAPTER_LIST_RE = re.compile(
+    r"""<(\w+)[^>]*\bid\s*=\s*["']Daftar_Chapter["'][^>]*>(.*?)</\1\s*>""",
+    re.IGNORECASE | re.DOTALL,
+)
+
+# Rows of komiku's "inftable": <td>Pengarang</td><td>...</td>
+INFO_ROW_RE = re.compile(r"<td[^>]*>\s*([^<]+?)\s*</td>\s*<td[^>]*>(.*?)</td>", re.IGNORECASE | re.DOTALL)
+INFO_FIELDS = {"judul komik": "title", "pengarang": "author", "status": "status", "jenis komik": "type"}
+GENRE_RE = re.compile(r"""itemprop=["']genre["'][^>]*>([^<]+)<""", re.IGNORECASE)
+SUMMARY_RE = re.compile(r"""<p[^>]*class=["'][^"']*\bdesc\b[^"']*["'][^>]*>(.*?)</p>""", re.IGNORECASE | re.DOTALL)
+HEADING_RE = re.compile(r"<h1[^>]*>(.*?)</h1>", re.IGNORECASE | re.DOTALL)
+TAG_RE = re.compile(r"<[^>]+>")
+
+_cache = OrderedDict()  # slug -> entry, least recently used first
+_lock = threading.Lock()
+
+def get_slug(manga_url):
+    """Series slug from a https://komiku.org/manga/<slug>/ link"""
+    return urlparse(manga_url).path.rstrip("/").split("/")[-1]
+
+def chapter_number(whole, fraction=None):
+    if fraction:
+        return float(f"{whole}.{fraction}")
+    return int(whole)
+
+def parse_chapters(html, page_url, slug=None):
+    """Return [(number, url)] for the chapters of the series on a series page, sorted by number
+
+    Only the chapter list (#Daftar_Chapter) is scanned when the page has one.
+    Chapter links don't always carry the series URL's slug, so the series'
+    own links are told apart from other series' (sidebar, recommendations)
+    by their prefix: the most common one wins, the series slug on a tie.
+    """
+    listing = CHAPTER_LIST_RE.search(html)
+    if listing:
+        html = listing.group(2)
+    slug = (slug or get_slug(page_url)).lower()
+    found = {}  # link prefix -> {number: url}
+    for match in CHAPTER_HREF_RE.finditer(html):
+        href, whole, fraction = match.groups()
+        url = urljoin(page_url, href)
+        prefix = get_slug(url).lower().rsplit("-chapter-", 1)[0]
+        found.setdefault(prefix, {}).setdefault(chapter_number(whole, fraction), url)
+    if not found:
+        return []
+    best = max(found, key=lambda prefix: (len(found[prefix]), prefix == slug))
+    return sorted(found[best].items())
+
+def _text(fragment):
+    return " ".join(htmllib.unescape(TAG_RE.sub("", fragment)).split())
+
+def parse_series_info(html, page_url):
+    """Series details for ComicInfo.xml: title, author, status, type, genres, summary and url (missing ones left out)"""
+    info = {"url": page_url}
+    for label, value in INFO_ROW_RE.findall(html):
+        field = INFO_FIELDS.get(_text(label).lower())
+        if field and field not in info and _text(value):
+            info[field] = _text(value)
+    if "title" not in info:
+        heading = HEADING_RE.search(html)
+        if heading and _text(heading.group(1)):
+            title = _text(heading.group(1))
+            info["title"] = title[len("Komik "):] if title.startswith("Komik ") else title
+    genres = [_text(genre) for genre in GENRE_RE.findall(html)]
+    if genres:
+        info["genres"] = list(dict.fromkeys(genres))
+    summary = SUMMARY_RE.search(html)
+    if summary and _text(summary.group(1)):
+        info["summary"] = _text(summary.group(1))
+    return info
+
+def _fetch(manga_url, entry):
+    headers = {}
+    if entry:
+        if entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+    slug = get_slug(manga_url)
+    with metrics.span("html_fetch", slug=slug):
+        resp = http_client.get(manga_url, headers=headers)
+    if resp.status_code == 304 and entry:
+        metrics.cache_requests.inc(cache="metadata", result="revalidated")
+        return entry["chapters"], entry["info"], resp
+    metrics.cache_requests.inc(cache="metadata", result="miss")
+    if resp.status_code != 200:
+        return None, None, resp
+    metrics.downloaded_bytes.inc(len(resp.content), kind="html")
+    page_url = resp.url or manga_url
+    with metrics.span("html_parse", slug=slug):
+        return parse_chapters(resp.text, page_url, slug), parse_series_info(resp.text, page_url), resp
+
+def _lookup(manga_url):
+    """Cache entry for a series, fetched or revalidated when it is older than METADATA_TTL; None if unavailable"""
+    slug = get_slug(manga_url)
+    with _lock:
+        entry = _cache.get(slug)
+        if entry:
+            _cache.move_to_end(slug)
+    if entry and time.time() - entry["fetched"] < METADATA_TTL:
+        metrics.cache_requests.inc(cache="metadata", result="hit")
+        return entry
+
+    try:
+        chapters, info, resp = _fetch(manga_url, entry)
+    except Exception as e:
+        print(f"❌ Gagal mengambil {manga_url}: {e}")
+        # Serve stale data rather than failing the user's request
+        return entry
+    if chapters is None:
+        return None
+
+    fresh = {
+        "chapters": chapters,
+        "info": info,
+        "fetched": time.time(),
+        # A 304 may omit the validators; keep the ones we already have
+        "etag": resp.headers.get("ETag") or (entry or {}).get("etag"),
+        "last_modified": resp.headers.get("Last-Modified") or (entry or {}).get("last_modified"),
+    }
+    _remember(slug, fresh)
+    return fresh
+
+def _remember(slug, entry):
+    if METADATA_CACHE_SIZE <= 0:
+        return
+    with _lock:
+        _cache[slug] = entry
+        _cache.move_to_end(slug)
+        while len(_cache) > METADATA_CACHE_SIZE:
+            _cache.popitem(last=False)
+
+def get_chapters(manga_url):
+    """Sorted [(number, url)] chapter list of a series, cached per slug; None if the page can't be fetched"""
+    entry = _lookup(manga_url)
+    return entry["chapters"] if entry else None
+
+def get_series_info(manga_url):
+    """Series details parsed from the same cached page as the chapter list; {} if it can't be fetched"""
+    entry = _lookup(manga_url)
+    return entry["info"] if entry else {}
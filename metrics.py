@@ -0,0 +1,241 @@
+# metrics.py
+# In-process counters and histograms, rendered in the Prometheus text format
+# at /metrics on the keep-alive server.
+#
+# Each hot-path stage (HTML fetch/parse, image fetch, decode, resize, encode,
+# PDF build, Telegram upload) runs inside span(). The stage duration goes into
+# a histogram labelled by stage only. The span's chat_id/slug/chapter labels
+# stay out of the metrics, since one series per chat and chapter would grow
+# without bound. They go into the recent-spans ring served at /spans instead,
+# and into a JSON log line per span when SPAN_LOG=1.
+#
+# Labels set with `with labels(...)` apply to every span opened in the same
+# thread (or task) inside that block. Pool threads don't inherit them, so code
+# that hands work to a pool passes its labels to span() explicitly.
+#
+# Startup milestones (bot ready, first update handled) are recorded once each,
+# in seconds since the process started, as komiku_startup_seconds.
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager
+
+# Print every span as a JSON line
+SPAN_LOG = os.getenv("SPAN_LOG", "0") == "1"
+# Spans kept for /spans
+RECENT_SPANS = int(os.getenv("RECENT_SPANS", "500"))
+
+# Seconds; pages take milliseconds to decode but uploads can take minutes
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+_labels = contextvars.ContextVar("span_labels", default={})
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+def _format_labels(names, values, extra=()):
+    pairs = [f'{name}="{_escape(value)}"' for name, value in list(zip(names, values)) + list(extra)]
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _number(value):
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            return self.values.get(key, 0)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self.lock:
+            for key, value in sorted(self.values.items()):
+                lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_number(value)}")
+        return lines
+
+class Histogram:
+    def __init__(self, name, help, labelnames=(), buckets=STAGE_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.values = {}  # label values -> [count per bucket..., sum, count]
+        self.lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self.lock:
+            entry = self.values.get(key)
+            if entry is None:
+                entry = self.values[key] = [0] * len(self.buckets) + [0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[i] += 1
+            entry[-2] += value
+            entry[-1] += 1
+
+    def totals(self):
+        """{label values: (count, sum)}"""
+        with self.lock:
+            return {key: (entry[-1], entry[-2]) for key, entry in self.values.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self.lock:
+            for key, entry in sorted(self.values.items()):
+                for bound, count in zip(self.buckets + (float("inf"),), entry[:-2] + [entry[-1]]):
+                    lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, [('le', _number(bound))])} {count}")
+                lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {_number(entry[-2])}")
+                lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {entry[-1]}")
+        return lines
+
+class Gauge:
+    """A value read when /metrics is scraped: func() returns a number or a {label values: number} dict"""
+
+    def __init__(self, name, help, func, labelnames=()):
+        self.name = name
+        self.help = help
+        self.func = func
+        self.labelnames = tuple(labelnames)
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} gauge"]
+        try:
+            value = self.func()
+        except Exception as e:
+            print(f"⚠️ Metric {self.name} failed: {e}")
+            return lines
+        samples = value.items() if isinstance(value, dict) else [((), value)]
+        for key, sample in sorted(samples):
+            lines.append(f"{self.name}{_format_labels(self.labelnames, key)} {_number(sample)}")
+        return lines
+
+_registry = []
+_registry_lock = threading.Lock()
+
+def register(metric):
+    with _registry_lock:
+        _registry.append(metric)
+    return metric
+
+def gauge(name, help, func, labelnames=()):
+    return register(Gauge(name, help, func, labelnames))
+
+def render():
+    """Every registered metric in the Prometheus text exposition format"""
+    with _registry_lock:
+        metrics = list(_registry)
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+stage_seconds = register(Histogram("komiku_stage_duration_seconds", "Time spent in each pipeline stage", ("stage",)))
+stage_errors = register(Counter("komiku_stage_errors_total", "Stage runs that raised", ("stage",)))
+cache_requests = register(Counter("komiku_cache_requests_total", "Cache lookups by cache and result", ("cache", "result")))
+downloaded_bytes = register(Counter("komiku_downloaded_bytes_total", "Bytes downloaded from upstream", ("kind",)))
+uploaded_bytes = register(Counter("komiku_uploaded_bytes_total", "Bytes uploaded to Telegram"))
+
+def _hit_ratios():
+    with cache_requests.lock:
+        values = dict(cache_requests.values)
+    totals, hits = {}, {}
+    for (cache, result), count in values.items():
+        totals[cache] = totals.get(cache, 0) + count
+        if result != "miss":
+            hits[cache] = hits.get(cache, 0) + count
+    return {(cache,): hits.get(cache, 0) / total for cache, total in totals.items() if total}
+
+gauge("komiku_cache_hit_ratio", "Share of cache lookups that were served from the cache", _hit_ratios, ("cache",))
+
+_imported = time.time()
+_startup = {}
+
+def process_uptime():
+    """Seconds since this process started; since this module was imported where /proc isn't available"""
+    try:
+        with open("/proc/self/stat") as f:
+            # Field 22 is the start time in clock ticks after boot; the command name may hold spaces
+            started = int(f.read().rpartition(")")[2].split()[19]) / os.sysconf("SC_CLK_TCK")
+        with open("/proc/uptime") as f:
+            return float(f.read().split()[0]) - started
+    except (OSError, ValueError, IndexError):
+        return time.time() - _imported
+
+def startup_mark(milestone):
+    """Record when milestone was first reached; later calls are ignored"""
+    if milestone in _startup:
+        return
+    seconds = _startup.setdefault(milestone, process_uptime())
+    print(f"⏱️ Startup: {milestone} after {seconds:.2f}s")
+
+def startup_times():
+    return dict(_startup)
+
+gauge(
+    "komiku_startup_seconds",
+    "Seconds from process start to each startup milestone",
+    lambda: {(milestone,): seconds for milestone, seconds in _startup.items()},
+    ("milestone",),
+)
+
+_recent = deque(maxlen=RECENT_SPANS)
+_recent_lock = threading.Lock()
+
+@contextmanager
+def labels(**values):
+    """Add chat_id/slug/chapter-style labels to every span opened inside the block"""
+    token = _labels.set({**_labels.get(), **values})
+    try:
+        yield
+    finally:
+        _labels.reset(token)
+
+def observe(stage, seconds, error=None, **span_labels):
+    """Record a finished span; used directly for stages timed somewhere span() can't reach (worker processes)"""
+    stage_seconds.observe(seconds, stage=stage)
+    if error is not None:
+        stage_errors.inc(stage=stage)
+    record = {"stage": stage, "seconds": round(seconds, 6), "ok": error is None, "at": round(time.time(), 3)}
+    record.update({key: value for key, value in {**_labels.get(), **span_labels}.items() if value is not None})
+    if error is not None:
+        record["error"] = type(error).__name__
+    with _recent_lock:
+        _recent.append(record)
+    if SPAN_LOG:
+        print("span " + json.dumps(record, default=str))
+
+@contextmanager
+def span(stage, **span_labels):
+    """Time the block as one run of stage"""
+    started = time.perf_counter()
+    error = None
+    try:
+        yield
+    except BaseException as e:
+        error = e
+        raise
+    finally:
+        observe(stage, time.perf_counter() - started, error, **span_labels)
+
+def recent_spans(limit=None):
+    with _recent_lock:
+        spans = list(_recent)
+    return spans[-limit:] if limit else spans
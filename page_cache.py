@@ -0,0 +1,155 @@
+# page_cache.py
+# Disk cache of upstream page images shared by every chat and chapter.
+#
+#   <PAGE_CACHE_DIR>/urls/ab/<sha256(url)>    -> text file holding the content hash
+#   <PAGE_CACHE_DIR>/blobs/cd/<sha256(body)>  -> the image bytes
+#
+# Every file is written to a temp name and os.replace()d into place, so readers
+# never see partial data and several threads or processes can share the cache.
+# Blob mtimes are bumped on every hit and the least recently used blobs are
+# evicted once the cache grows past PAGE_CACHE_MAX_MB.
+import hashlib
+import os
+import shutil
+import tempfile
+import threading
+
+PAGE_CACHE_DIR = os.getenv("PAGE_CACHE_DIR", os.path.join("cache", "pages"))
+PAGE_CACHE_MAX_BYTES = int(float(os.getenv("PAGE_CACHE_MAX_MB", "2048")) * 1024 * 1024)
+# Eviction trims the cache down to this fraction of the cap
+EVICT_TARGET = 0.9
+
+_lock = threading.Lock()
+_total_bytes = None  # lazily measured on first store
+
+def enabled():
+    return PAGE_CACHE_MAX_BYTES > 0
+
+def _sha256(data):
+    return hashlib.sha256(data).hexdigest()
+
+def _url_path(url):
+    key = _sha256(url.encode())
+    return os.path.join(PAGE_CACHE_DIR, "urls", key[:2], key)
+
+def _blob_path(digest):
+    return os.path.join(PAGE_CACHE_DIR, "blobs", digest[:2], digest)
+
+def _write_file(path, data):
+    with open(path, "wb") as f:
+        f.write(data)
+
+def _atomic_write(path, data):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        os.close(fd)
+        _write_file(tmp_path, data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def _lookup(url):
+    try:
+        with open(_url_path(url)) as f:
+            blob = _blob_path(f.read().strip())
+        os.utime(blob)  # mark as recently used
+        return blob
+    except (FileNotFoundError, ValueError):
+        return None
+
+def fetch(url, dest_path):
+    """Copy a cached page to dest_path; returns False on a miss"""
+    if not enabled():
+        return False
+    blob = _lookup(url)
+    if not blob:
+        return False
+    try:
+        shutil.copyfile(blob, dest_path)
+        return True
+    except FileNotFoundError:
+        # Evicted between lookup and copy
+        return False
+
+def _hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def _add_blob(digest, write_tmp):
+    blob = _blob_path(digest)
+    if os.path.exists(blob):
+        return 0
+    os.makedirs(os.path.dirname(blob), exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(blob), suffix=".tmp")
+    os.close(fd)
+    try:
+        write_tmp(tmp_path)
+        size = os.path.getsize(tmp_path)
+        os.replace(tmp_path, blob)
+        return size
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+def store(url, src_path):
+    """Add a downloaded page file to the cache"""
+    if not enabled():
+        return
+    try:
+        digest = _hash_file(src_path)
+        added = _add_blob(digest, lambda tmp_path: shutil.copyfile(src_path, tmp_path))
+        _atomic_write(_url_path(url), digest.encode())
+        _account(added)
+    except OSError as e:
+        print(f"⚠️ Page cache write failed for {url}: {e}")
+
+def _blob_files():
+    blobs_dir = os.path.join(PAGE_CACHE_DIR, "blobs")
+    for root, _, files in os.walk(blobs_dir):
+        for name in files:
+            if not name.endswith(".tmp"):
+                yield os.path.join(root, name)
+
+def _account(added):
+    global _total_bytes
+    with _lock:
+        if _total_bytes is None:
+            _total_bytes = sum(os.path.getsize(path) for path in _blob_files())
+        else:
+            _total_bytes += added
+        if _total_bytes > PAGE_CACHE_MAX_BYTES:
+            _evict()
+
+def _evict():
+    """Delete least recently used blobs until the cache is under EVICT_TARGET of the cap"""
+    global _total_bytes
+    entries = []
+    for path in _blob_files():
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+        entries.append((stat.st_mtime, stat.st_size, path))
+    entries.sort()
+    total = sum(size for _, size, _ in entries)
+    target = PAGE_CACHE_MAX_BYTES * EVICT_TARGET
+    removed = 0
+    for _, size, path in entries:
+        if total <= target:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        removed += 1
+    # URL entries pointing at evicted blobs are treated as misses and overwritten on the next store
+    _total_bytes = total
+    print(f"🧹 Page cache evicted {removed} images ({total // (1024 * 1024)} MB left)")
@@ -0,0 +1,109 @@
+# pdf_writer.py
+# Writes a PDF one page at a time. JPEG pages are copied into the file as
+# DCTDecode streams without being decoded, other formats are re-encoded to JPEG
+# one page at a time, so memory stays bounded by a single page however many
+# chapters are merged.
+import os
+import shutil
+from io import BytesIO
+import imaging
+
+# JPEG colour modes a PDF viewer can show as-is
+_PASSTHROUGH_MODES = {"RGB": b"/DeviceRGB", "L": b"/DeviceGray"}
+
+def is_passthrough_jpeg(img):
+    """True when an opened image is a JPEG that can be embedded without re-encoding"""
+    return img.format == "JPEG" and img.mode in _PASSTHROUGH_MODES
+
+class PdfWriter:
+    """Append-only PDF writer with one image per page, sized like Pillow's PDF output (1px = 1pt)"""
+
+    def __init__(self, output_pdf):
+        self.file = open(output_pdf, "wb")
+        self.offsets = {}
+        self.page_ids = []
+        self.next_id = 3  # 1 = catalog, 2 = page tree; both written on close
+        self.file.write(b"%PDF-1.4\n%\xe2\xe3\xcf\xd3\n")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.file.close()
+
+    def _reserve(self):
+        obj_id = self.next_id
+        self.next_id += 1
+        return obj_id
+
+    def _begin(self, obj_id):
+        self.offsets[obj_id] = self.file.tell()
+        self.file.write(b"%d 0 obj\n" % obj_id)
+
+    def _write_object(self, obj_id, body):
+        self._begin(obj_id)
+        self.file.write(body)
+        self.file.write(b"\nendobj\n")
+
+    def _write_stream(self, obj_id, header, length, source):
+        self._begin(obj_id)
+        self.file.write(b"<< %s /Length %d >>\nstream\n" % (header, length))
+        if isinstance(source, bytes):
+            self.file.write(source)
+        else:
+            with open(source, "rb") as f:
+                shutil.copyfileobj(f, self.file)
+        self.file.write(b"\nendstream\nendobj\n")
+
+    def add_jpeg(self, source, width, height, colorspace=b"/DeviceRGB", length=None):
+        """Add a page from JPEG bytes or a JPEG file path without decoding it"""
+        if length is None:
+            length = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+        image_id, content_id, page_id = self._reserve(), self._reserve(), self._reserve()
+        self._write_stream(
+            image_id,
+            b"/Type /XObject /Subtype /Image /Width %d /Height %d /ColorSpace %s "
+            b"/BitsPerComponent 8 /Filter /DCTDecode" % (width, height, colorspace),
+            length,
+            source,
+        )
+        content = b"q %d 0 0 %d 0 0 cm /Im0 Do Q" % (width, height)
+        self._write_stream(content_id, b"", len(content), content)
+        self._write_object(
+            page_id,
+            b"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 %d %d] "
+            b"/Resources << /XObject << /Im0 %d 0 R >> >> /Contents %d 0 R >>"
+            % (width, height, image_id, content_id),
+        )
+        self.page_ids.append(page_id)
+
+    def add_image(self, img_path):
+        """Add a page from an image file, re-encoding only when it isn't an RGB/greyscale JPEG"""
+        from PIL import Image
+        with Image.open(img_path) as img:
+            width, height = img.size
+            if is_passthrough_jpeg(img):
+                self.add_jpeg(img_path, width, height, _PASSTHROUGH_MODES[img.mode])
+                return
+        with imaging.decode_budget.reserve(imaging.decoded_size(img_path)):
+            with Image.open(img_path) as img:
+                buffer = BytesIO()
+                img.convert("RGB").save(buffer, "JPEG", quality=95)
+        self.add_jpeg(buffer.getvalue(), width, height)
+
+    def close(self):
+        if self.file.closed:
+            return
+        kids = b" ".join(b"%d 0 R" % page_id for page_id in self.page_ids)
+        self._write_object(2, b"<< /Type /Pages /Kids [%s] /Count %d >>" % (kids, len(self.page_ids)))
+        self._write_object(1, b"<< /Type /Catalog /Pages 2 0 R >>")
+        xref_offset = self.file.tell()
+        size = self.next_id
+        self.file.write(b"xref\n0 %d\n0000000000 65535 f \n" % size)
+        for obj_id in range(1, size):
+            self.file.write(b"%010d 00000 n \n" % self.offsets[obj_id])
+        self.file.write(b"trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n" % (size, xref_offset))
+        self.file.close()
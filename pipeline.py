@@ -0,0 +1,187 @@
+# pipeline.py
+# Asyncio variant of download_chapter / download_chapter_big where page fetches
+# and the Pillow decode/re-encode overlap as separate stages instead of each
+# page being fetched and transformed by one worker. Stages are joined by
+# bounded queues, so a slow stage applies backpressure to the ones feeding it.
+# Pages travel between stages as .part files on disk, never as whole response
+# bodies in memory.
+#
+# Pages land in the same per-series chapter folders as the threaded path, with
+# the same manifest, so either path resumes what the other left. Selected with
+# PAGE_PIPELINE=asyncio (see downloader.download_chapters); asyncio callers
+# can await download_chapter_async directly.
+import asyncio
+import os
+import random
+from concurrent.futures import ThreadPoolExecutor
+import extractor
+import imaging
+from manifest import ChapterManifest
+from singleflight import chapter_flights, chapter_leases
+from downloader import (
+    PAGE_RETRY_PASSES,
+    PAGE_WORKERS,
+    Pages,
+    download_to_file,
+    drop_partial,
+    fetch_slots,
+    finish_page_normal,
+    get_chapter_folder,
+    is_cancelled,
+    span_labels,
+)
+
+# Pages allowed to wait between two stages
+PIPELINE_QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "8"))
+# Threads running Pillow decode/encode (Pillow releases the GIL while coding)
+TRANSFORM_WORKERS = int(os.getenv("TRANSFORM_WORKERS", "2"))
+
+_transform_pool = ThreadPoolExecutor(max_workers=TRANSFORM_WORKERS, thread_name_prefix="transform")
+
+def _fetch_file(img_url, part_path, labels):
+    with fetch_slots:
+        download_to_file(img_url, part_path, labels)
+
+async def _pipeline(chapter_url, chapter_num, OUTPUT_DIR, chat_id=None, user_cancel=None, big=False):
+    """Pipelined download of one chapter into its folder; Pages in page order, or [] if cancelled or unreachable"""
+    label = "BIG MODE: " if big else ""
+    print(f"[*] {label}Mengambil gambar dari {chapter_url}")
+    labels = span_labels(chat_id, OUTPUT_DIR, chapter_num)
+    img_urls = await asyncio.to_thread(extractor.chapter_pages, chapter_url, big, labels)
+    if img_urls is None:
+        return []
+
+    chapter_folder = get_chapter_folder(OUTPUT_DIR, chapter_num, big)
+    os.makedirs(chapter_folder, exist_ok=True)
+    manifest = ChapterManifest(chapter_folder, chapter_url)
+    loop = asyncio.get_running_loop()
+    if big:
+        # Runs in the imaging process pool; the executor thread only waits on it
+        transform = imaging.upscale
+    else:
+        transform = finish_page_normal
+    fetch_workers = max(1, PAGE_WORKERS)
+    urls = []
+    results = {}  # page index -> image path, None when the page failed
+
+    def cancelled():
+        return is_cancelled(chat_id, user_cancel)
+
+    def failed(i, img_url, img_path, e):
+        print(f"    [!] Gagal download {img_url}: {e}")
+        manifest.mark_failed(i, img_url, e)
+        drop_partial(img_path, e)
+        results[i] = None
+
+    # The first pass takes pages as the extractor finds them in the HTML
+    async def listed():
+        pages = iter(img_urls)
+        while (img_url := await asyncio.to_thread(next, pages, None)) is not None:
+            urls.append(img_url)
+            yield len(urls), img_url
+
+    async def retried(indices):
+        for i in indices:
+            yield i, urls[i - 1]
+
+    async def run_pass(pages):
+        pending = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+        fetched = asyncio.Queue(PIPELINE_QUEUE_SIZE)
+
+        async def feed_stage():
+            try:
+                async for item in pages:
+                    if cancelled():
+                        break
+                    await pending.put(item)
+            finally:
+                for _ in range(fetch_workers):
+                    await pending.put(None)
+
+        async def fetch_stage():
+            while (item := await pending.get()) is not None:
+                i, img_url = item
+                if cancelled():
+                    continue
+                img_path = os.path.join(chapter_folder, f"{i:03}.jpg")
+                # Pages finished by an earlier run are kept (hashing runs off the loop)
+                if await asyncio.to_thread(manifest.is_done, i, img_url, img_path):
+                    results[i] = img_path
+                    continue
+                try:
+                    await asyncio.to_thread(_fetch_file, img_url, img_path + ".part", labels)
+                except Exception as e:
+                    failed(i, img_url, img_path, e)
+                    continue
+                await fetched.put((i, img_url, img_path))
+
+        async def transform_stage():
+            while (item := await fetched.get()) is not None:
+                i, img_url, img_path = item
+                if cancelled():
+                    continue
+                try:
+                    await loop.run_in_executor(_transform_pool, transform, img_path + ".part", img_path, labels)
+                except Exception as e:
+                    failed(i, img_url, img_path, e)
+                    continue
+                await asyncio.to_thread(manifest.mark_done, i, img_url, img_path)
+                results[i] = img_path
+                print(f"    > {label}Download gambar {i}")
+
+        transformers = [asyncio.create_task(transform_stage()) for _ in range(TRANSFORM_WORKERS)]
+        try:
+            fed = await asyncio.gather(feed_stage(), *(fetch_stage() for _ in range(fetch_workers)), return_exceptions=True)
+        finally:
+            for _ in transformers:
+                await fetched.put(None)
+            await asyncio.gather(*transformers)
+        # A page list cut off mid-stream fails the chapter like an unreachable chapter page would
+        for error in fed:
+            if isinstance(error, BaseException):
+                raise error
+
+    try:
+        await run_pass(listed())
+        for attempt in range(1, PAGE_RETRY_PASSES + 1):
+            pending = [i for i in range(1, len(urls) + 1) if results.get(i) is None]
+            if not pending or cancelled():
+                break
+            print(f"    [*] Mengulang {len(pending)} gambar yang gagal (percobaan {attempt})")
+            await asyncio.sleep(min(10, 2 ** attempt) + random.uniform(0, 1))
+            await run_pass(retried(pending))
+    finally:
+        img_urls.close()
+
+    if cancelled():
+        print(f"[!] {label}Download cancelled for chapter {chapter_num}")
+        return []
+    if not urls:
+        print(f"[!] Tidak ada gambar ditemukan di {chapter_url}")
+    saved = [results[i] for i in range(1, len(urls) + 1) if results.get(i)]
+    return Pages(saved, complete=bool(urls) and len(saved) == len(urls))
+
+def download_chapter_pipeline(chapter_url, chapter_num, OUTPUT_DIR, chat_id=None, user_cancel=None, big=False):
+    """Blocking entry point with download_chapter's arguments, callable from worker threads"""
+    return asyncio.run(_pipeline(chapter_url, chapter_num, OUTPUT_DIR, chat_id, user_cancel, big))
+
+async def download_chapter_async(chapter_url, chapter_num, OUTPUT_DIR, chat_id=None, user_cancel=None, big=False, owner=None):
+    """Pipelined chapter download for asyncio callers; returns Pages in page order, or [] if cancelled
+
+    Like downloader.download_chapters, concurrent requests for the same
+    chapter folder share one download, and with owner the folder is leased
+    to it until released via chapter_leases.
+    """
+    if is_cancelled(chat_id, user_cancel):
+        return []
+    folder = get_chapter_folder(OUTPUT_DIR, chapter_num, big)
+    if owner is not None:
+        chapter_leases.acquire(folder, owner)
+    loop = asyncio.get_running_loop()
+
+    def run(cancel):
+        # The shared download runs on this loop; the flight's thread only waits for it
+        coro = _pipeline(chapter_url, chapter_num, OUTPUT_DIR, chat_id, cancel, big)
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+
+    return await asyncio.to_thread(chapter_flights.do, folder, run, lambda: is_cancelled(chat_id, user_cancel))
@@ -0,0 +1,137 @@
+# rate_limit.py
+# Request policy shared by every download path.
+#
+# Upstream: every request to komiku.org or an image host takes a token from a
+# global bucket and from that host's bucket first (see http_client.get), so no
+# mix of users, prefetching and /autodemo can hammer a host hard enough to get
+# the bot throttled or banned.
+#
+# Per chat: how many chapters one request may cover, and how many chapters a
+# chat may ask for per hour (a sliding window), with the wait time reported
+# back so the user can be told when to try again.
+import os
+import threading
+import time
+from collections import deque
+from urllib.parse import urlparse
+
+# Upstream requests per second (sustained) and burst size, across all hosts
+UPSTREAM_RATE = float(os.getenv("UPSTREAM_RATE", "20"))
+UPSTREAM_BURST = int(os.getenv("UPSTREAM_BURST", "40"))
+# The same for each single host
+HOST_RATE = float(os.getenv("HOST_RATE", "10"))
+HOST_BURST = int(os.getenv("HOST_BURST", "20"))
+
+# Chapters one /manga or /komik request may cover
+MAX_CHAPTERS_NORMAL = int(os.getenv("MAX_CHAPTERS_NORMAL", "20"))
+MAX_CHAPTERS_BIG = int(os.getenv("MAX_CHAPTERS_BIG", "3"))
+# Chapters a chat may request per hour; 0 disables the quota
+CHAPTERS_PER_HOUR = int(os.getenv("CHAPTERS_PER_HOUR", "60"))
+QUOTA_WINDOW = 3600
+
+class TokenBucket:
+    """Thread-safe token bucket; acquire() blocks until a token is available"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self):
+        """Take a token, going into debt if there is none; returns how long the caller must wait"""
+        with self.lock:
+            self._refill(time.monotonic())
+            self.tokens -= 1
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def acquire(self):
+        if self.rate <= 0:
+            return
+        wait = self.reserve()
+        if wait:
+            time.sleep(wait)
+
+class UpstreamThrottle:
+    """A global bucket plus one bucket per host"""
+
+    def __init__(self, rate=UPSTREAM_RATE, burst=UPSTREAM_BURST, host_rate=HOST_RATE, host_burst=HOST_BURST):
+        self.bucket = TokenBucket(rate, burst)
+        self.host_rate = host_rate
+        self.host_burst = host_burst
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def _host_bucket(self, host):
+        with self.lock:
+            if host not in self.hosts:
+                self.hosts[host] = TokenBucket(self.host_rate, self.host_burst)
+            return self.hosts[host]
+
+    def wait(self, url):
+        """Block until a request to url is allowed by both the global and the host limit"""
+        self._host_bucket(urlparse(url).hostname or "").acquire()
+        self.bucket.acquire()
+
+class ChapterQuota:
+    """Sliding-window count of chapters requested per chat"""
+
+    def __init__(self, limit=CHAPTERS_PER_HOUR, window=QUOTA_WINDOW):
+        self.limit = limit
+        self.window = window
+        self.used = {}  # chat_id -> deque of (timestamp, chapters)
+        self.lock = threading.Lock()
+
+    def _expire(self, chat_id, now):
+        entries = self.used.get(chat_id)
+        while entries and now - entries[0][0] >= self.window:
+            entries.popleft()
+        if entries is not None and not entries:
+            del self.used[chat_id]
+        return entries or ()
+
+    def check(self, chat_id, chapters):
+        """Seconds until chat_id may request this many chapters; 0 when it may now"""
+        if self.limit <= 0:
+            return 0
+        with self.lock:
+            now = time.time()
+            entries = self._expire(chat_id, now)
+            used = sum(count for _, count in entries)
+            if used + chapters <= self.limit:
+                return 0
+            # Wait until enough of the oldest requests fall out of the window
+            for stamp, count in entries:
+                used -= count
+                if used + chapters <= self.limit:
+                    return max(1, int(stamp + self.window - now) + 1)
+            return self.window
+
+    def record(self, chat_id, chapters):
+        if self.limit <= 0 or chapters <= 0:
+            return
+        with self.lock:
+            self.used.setdefault(chat_id, deque()).append((time.time(), chapters))
+
+    def remaining(self, chat_id):
+        if self.limit <= 0:
+            return None
+        with self.lock:
+            return self.limit - sum(count for _, count in self._expire(chat_id, time.time()))
+
+def max_chapters(mode):
+    """Chapters one request may cover in the given download mode ("normal" or "big")"""
+    return MAX_CHAPTERS_BIG if mode == "big" else MAX_CHAPTERS_NORMAL
+
+def describe_wait(seconds):
+    """Human wait time for quota messages, e.g. "12 menit" """
+    minutes = (seconds + 59) // 60
+    return f"{minutes} menit" if minutes > 1 else "1 menit"
+
+upstream = UpstreamThrottle()
+chapter_quota = ChapterQuota()
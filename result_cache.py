@@ -0,0 +1,97 @@
+# result_cache.py
+# Remembers the Telegram file_id of every PDF the bot has uploaded so the same
+# manga/chapter/mode request can be answered by re-sending that file_id, with no
+# download, PDF build or upload. The index is a small SQLite file so it
+# survives restarts and can be shared by several bot processes on one host.
+import os
+import sqlite3
+import threading
+import time
+from contextlib import closing
+
+RESULT_CACHE_PATH = os.getenv("RESULT_CACHE_PATH", os.path.join("cache", "results.db"))
+# Entries older than this are rebuilt so fixed-up chapters eventually reach users
+RESULT_CACHE_TTL = int(os.getenv("RESULT_CACHE_TTL", str(7 * 24 * 3600)))
+
+_local = threading.local()  # one connection per thread, reused across calls
+_setup_lock = threading.Lock()
+_ready = False
+
+def _setup():
+    """Create the index file and its table; runs once per process"""
+    global _ready
+    with _setup_lock:
+        if _ready:
+            return
+        os.makedirs(os.path.dirname(RESULT_CACHE_PATH) or ".", exist_ok=True)
+        with closing(sqlite3.connect(RESULT_CACHE_PATH, timeout=10)) as conn:
+            # WAL is a property of the database file, so it only needs setting once
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                " key TEXT PRIMARY KEY,"
+                " file_id TEXT NOT NULL,"
+                " created REAL NOT NULL)"
+            )
+            conn.commit()
+        _ready = True
+
+def _connect():
+    """This thread's connection to the index; use it as `with _connect() as conn` for one transaction"""
+    if not _ready:
+        _setup()
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = _local.conn = sqlite3.connect(RESULT_CACHE_PATH, timeout=10)
+    return conn
+
+def make_key(slug, chapters, mode, merge_mode, output_format="pdf"):
+    """Cache key for one delivered document; chapters is a chapter number or an (awal, akhir) range"""
+    if isinstance(chapters, tuple):
+        chapters = f"{chapters[0]}-{chapters[1]}"
+    key = f"{slug}|{chapters}|{mode}|{merge_mode}"
+    # PDF keys keep their original form so file_ids cached before CBZ existed stay valid
+    return key if output_format == "pdf" else f"{key}|{output_format}"
+
+def get(key):
+    """Return the cached file_id for key, or None when missing or expired"""
+    try:
+        with _connect() as conn:
+            row = conn.execute("SELECT file_id, created FROM results WHERE key = ?", (key,)).fetchone()
+            if not row:
+                return None
+            file_id, created = row
+            if time.time() - created > RESULT_CACHE_TTL:
+                conn.execute("DELETE FROM results WHERE key = ?", (key,))
+                return None
+            return file_id
+    except sqlite3.Error as e:
+        print(f"⚠️ Result cache read failed: {e}")
+        return None
+
+def put(key, file_id):
+    try:
+        with _connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO results (key, file_id, created) VALUES (?, ?, ?)",
+                (key, file_id, time.time()),
+            )
+    except sqlite3.Error as e:
+        print(f"⚠️ Result cache write failed: {e}")
+
+def invalidate(key):
+    try:
+        with _connect() as conn:
+            conn.execute("DELETE FROM results WHERE key = ?", (key,))
+    except sqlite3.Error as e:
+        print(f"⚠️ Result cache delete failed: {e}")
+
+def purge_expired():
+    """Delete expired entries; returns how many were removed"""
+    try:
+        with _connect() as conn:
+            cursor = conn.execute("DELETE FROM results WHERE created < ?", (time.time() - RESULT_CACHE_TTL,))
+            return cursor.rowcount
+    except sqlite3.Error as e:
+        print(f"⚠️ Result cache purge failed: {e}")
+        return 0
@@ -0,0 +1,99 @@
+# singleflight.py
+# Coalesces identical chapter downloads. Right after a release many chats ask
+# for the same chapter at once; the first request downloads it and every other
+# request for the same (slug, chapter, mode) attaches to that download and gets
+# the same pages. The key is the chapter folder, which is namespaced by slug
+# and mode (downloads/<slug>/chapter-<n>[-big]).
+#
+# The shared folder is leased by every job that uses its pages and removed
+# only when the last lease is released.
+import os
+import shutil
+import threading
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.cancelled = []  # one "has this requester cancelled?" check per caller
+
+    def get(self, _chat_id, default=None):
+        """Stands in for the user_cancel dict: the shared download stops only when every requester has cancelled"""
+        return all(cancelled() for cancelled in self.cancelled)
+
+class SingleFlight:
+    """Runs at most one call per key; callers for a key already in flight wait for that call's result"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+
+    def do(self, key, func, cancelled=lambda: False):
+        """Return func(cancel), run once for all concurrent callers of key
+
+        cancelled tells whether this caller has given up. cancel is a
+        user_cancel-like object for the shared run: cancel.get(chat_id) is true
+        only once every attached caller has cancelled.
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            call.cancelled.append(cancelled)
+        if not leader:
+            print(f"[*] Menunggu download yang sama yang sedang berjalan: {key}")
+            while not call.done.wait(1):
+                if cancelled():
+                    return []
+        else:
+            try:
+                call.result = func(call)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self.lock:
+                    del self.calls[key]
+                call.done.set()
+        if call.error:
+            raise call.error
+        # Followers whose own chat cancelled get nothing, like an ordinary cancelled download
+        if cancelled():
+            return []
+        return call.result
+
+class FolderLeases:
+    """Reference counts of the jobs using each chapter folder"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.holders = {}  # folder -> set of owners
+
+    def acquire(self, folder, owner):
+        with self.lock:
+            self.holders.setdefault(folder, set()).add(owner)
+
+    def release(self, folder, owner, remove=True):
+        """Drop owner's lease; the folder is deleted once nobody holds it, unless remove is False (kept for resume)"""
+        with self.lock:
+            owners = self.holders.get(folder)
+            if not owners or owner not in owners:
+                return False
+            owners.discard(owner)
+            if owners:
+                return False
+            del self.holders[folder]
+            # Removed under the lock so a new download can't start writing into it meanwhile
+            if remove and os.path.exists(folder):
+                shutil.rmtree(folder, ignore_errors=True)
+                print(f"🗑️ Deleted folder: {folder}")
+                return True
+            return False
+
+    def in_use(self, folder):
+        with self.lock:
+            return folder in self.holders
+
+chapter_flights = SingleFlight()
+chapter_leases = FolderLeases()
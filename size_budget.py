@@ -0,0 +1,126 @@
+# size_budget.py
+# Keeps every PDF the bot sends under Telegram's 50 MB bot upload cap. When the
+# pages of a document add up to more than the budget, each page is re-encoded
+# with the highest JPEG quality (and, failing that, the mildest downscale) whose
+# estimated size fits its share of the budget. The estimate comes from a binary
+# search over encodes of a small banded sample of the page, not the full page.
+# Whatever still doesn't fit is split into numbered parts.
+import os
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import imaging
+import metrics
+from layout import derived_path
+
+# Bytes allowed per sent PDF; a little under Telegram's 50 MB so the PDF structure fits too. 0 disables
+PDF_SIZE_BUDGET = int(float(os.getenv("PDF_SIZE_BUDGET_MB", "48")) * 1024 * 1024)
+MIN_QUALITY = int(os.getenv("MIN_JPEG_QUALITY", "55"))
+MAX_QUALITY = 95
+# Pages are downscaled in SCALE_STEP steps, never below MIN_SCALE of their size
+MIN_SCALE = float(os.getenv("MIN_PAGE_SCALE", "0.5"))
+SCALE_STEP = 0.8
+# Per-page share is aimed this far under the exact ratio, since sample estimates are approximate
+TARGET_MARGIN = 0.95
+# The sample is SAMPLE_BANDS full-width bands spread evenly down the page
+SAMPLE_BANDS = 4
+SAMPLE_BAND_ROWS = 64
+# PDF bytes outside the image streams: per page, and per document
+PDF_PAGE_OVERHEAD = 256
+PDF_BASE_OVERHEAD = 1024
+
+def _encoded_size(img, quality):
+    buffer = BytesIO()
+    img.save(buffer, "JPEG", quality=quality)
+    return buffer.tell()
+
+def _sample(img):
+    """A banded sample of img and the factor that scales its encoded size up to the whole page"""
+    from PIL import Image
+    width, height = img.size
+    rows = SAMPLE_BANDS * SAMPLE_BAND_ROWS
+    if height <= rows:
+        return img, 1.0
+    sample = Image.new("RGB", (width, rows))
+    step = (height - SAMPLE_BAND_ROWS) / (SAMPLE_BANDS - 1)
+    for band in range(SAMPLE_BANDS):
+        top = int(band * step)
+        sample.paste(img.crop((0, top, width, top + SAMPLE_BAND_ROWS)), (0, band * SAMPLE_BAND_ROWS))
+    return sample, height / rows
+
+def _best_quality(sample, target_bytes):
+    """Highest quality whose encoded sample is within target_bytes, or None if even MIN_QUALITY is too big"""
+    low, high, best = MIN_QUALITY, MAX_QUALITY, None
+    while low <= high:
+        quality = (low + high) // 2
+        if _encoded_size(sample, quality) <= target_bytes:
+            best, low = quality, quality + 1
+        else:
+            high = quality - 1
+    return best
+
+def choose_encoding(img, target_bytes):
+    """(scale, quality) expected to encode img in target_bytes, preferring full size; the floors of both when nothing fits"""
+    from PIL import Image
+    sample, factor = _sample(img)
+    scale = 1.0
+    while True:
+        if scale == 1.0:
+            scaled = sample
+        else:
+            scaled = sample.resize((max(1, int(sample.width * scale)), max(1, int(sample.height * scale))), Image.Resampling.LANCZOS)
+        quality = _best_quality(scaled, target_bytes / factor)
+        if quality is not None:
+            return scale, quality
+        if scale <= MIN_SCALE:
+            return scale, MIN_QUALITY
+        scale = max(MIN_SCALE, scale * SCALE_STEP)
+
+def shrink_page(img_path, target_bytes, out_dir=None):
+    """Re-encode a page to about target_bytes; returns the new path, or img_path when that didn't make it smaller"""
+    from PIL import Image
+    out_path = derived_path(img_path, "-fit", out_dir)
+    with imaging.decode_budget.reserve(imaging.decoded_size(img_path)):
+        with Image.open(img_path) as img:
+            img = img.convert("RGB")
+        scale, quality = choose_encoding(img, target_bytes)
+        if scale < 1.0:
+            img = img.resize((max(1, int(img.width * scale)), max(1, int(img.height * scale))), Image.Resampling.LANCZOS)
+        img.save(out_path, "JPEG", quality=quality)
+    if os.path.getsize(out_path) >= os.path.getsize(img_path):
+        os.remove(out_path)
+        return img_path
+    return out_path
+
+def split_parts(pages, budget):
+    """Group pages, in order, into parts whose estimated PDF size stays within budget"""
+    parts = []
+    current, used = [], PDF_BASE_OVERHEAD
+    for img_path in pages:
+        size = os.path.getsize(img_path) + PDF_PAGE_OVERHEAD
+        if current and used + size > budget:
+            parts.append(current)
+            current, used = [], PDF_BASE_OVERHEAD
+        current.append(img_path)
+        used += size
+    if current:
+        parts.append(current)
+    return parts
+
+def fit_pages(pages, budget=None, out_dir=None):
+    """Pages of one document grouped into parts that each fit budget bytes, recompressing them first if needed"""
+    budget = PDF_SIZE_BUDGET if budget is None else budget
+    if budget <= 0 or not pages:
+        return [pages]
+    sizes = [os.path.getsize(img_path) + PDF_PAGE_OVERHEAD for img_path in pages]
+    total = sum(sizes) + PDF_BASE_OVERHEAD
+    if total > budget:
+        ratio = budget / total * TARGET_MARGIN
+        print(f"[*] PDF {total / 1024 / 1024:.1f} MB melebihi batas, kompres halaman ke ~{ratio:.0%}")
+        # Pillow releases the GIL while coding; the decode budget bounds the memory in use
+        with metrics.span("size_fit"), ThreadPoolExecutor(max_workers=max(1, imaging.IMAGE_WORKERS)) as pool:
+            targets = [int(size * ratio) for size in sizes]
+            pages = list(pool.map(shrink_page, pages, targets, [out_dir] * len(pages)))
+    parts = split_parts(pages, budget)
+    if len(parts) > 1:
+        print(f"[*] PDF dipecah menjadi {len(parts)} bagian")
+    return parts
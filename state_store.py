@@ -0,0 +1,310 @@
+# state_store.py
+# Per-chat bot state kept behind a small key-value store, so several bot
+# processes can share it. This covers conversation sessions, /cancel flags and
+# autodemo switches. STATE_STORE picks the backend:
+#
+#   memory (default)          this process only
+#   sqlite:///path/state.db   every process on one host
+#   redis://host:6379/0       processes on any host (needs the redis package)
+#   dictredis://              the Redis backend on an in-process stand-in (tests)
+#
+# Every record carries a TTL, so abandoned sessions expire by themselves. The
+# memory backend keeps expiry times in a heap and the SQLite one has an index
+# on them, so expiry never scans the whole store.
+import heapq
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from contextlib import closing
+
+STATE_STORE = os.getenv("STATE_STORE", "memory")
+# Prefix for every key, so several bots can share one Redis
+STATE_PREFIX = os.getenv("STATE_PREFIX", "komiku:")
+# An untouched conversation is forgotten after this long
+SESSION_TTL = int(os.getenv("SESSION_TTL", "3600"))
+FLAG_TTL = int(os.getenv("FLAG_TTL", str(24 * 3600)))
+# How long a flag read from a shared store is reused; cancel checks run for every page
+FLAG_CACHE_SECONDS = float(os.getenv("FLAG_CACHE_SECONDS", "1"))
+
+class MemoryStore:
+    """Dict-backed store for a single process; expired keys are popped off a heap of expiry times"""
+
+    shared = False
+
+    def __init__(self):
+        self.data = {}     # key -> (value, expires)
+        self.expiry = []   # heap of (expires, key); stale after a key is rewritten
+        self.lock = threading.Lock()
+
+    def _purge(self, now):
+        removed = 0
+        while self.expiry and self.expiry[0][0] <= now:
+            expires, key = heapq.heappop(self.expiry)
+            entry = self.data.get(key)
+            if entry and entry[1] == expires:
+                del self.data[key]
+                removed += 1
+        return removed
+
+    def get(self, key):
+        with self.lock:
+            self._purge(time.time())
+            entry = self.data.get(key)
+            return entry[0] if entry else None
+
+    def set(self, key, value, ttl):
+        expires = time.time() + ttl
+        with self.lock:
+            self.data[key] = (value, expires)
+            heapq.heappush(self.expiry, (expires, key))
+
+    def delete(self, key):
+        with self.lock:
+            self.data.pop(key, None)
+
+    def purge(self):
+        """Drop expired keys; returns how many were removed"""
+        with self.lock:
+            return self._purge(time.time())
+
+class SqliteStore:
+    """Store in a SQLite file shared by every process on the host"""
+
+    shared = True
+
+    def __init__(self, path):
+        self.path = path
+        self.local = threading.local()  # one connection per thread, reused across calls
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with closing(sqlite3.connect(path, timeout=10)) as conn:
+            # WAL is a property of the database file, so it only needs setting once
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS state ("
+                " key TEXT PRIMARY KEY,"
+                " value TEXT NOT NULL,"
+                " expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE INDEX IF NOT EXISTS state_expires ON state (expires)")
+            conn.commit()
+
+    def _connect(self):
+        """This thread's connection; use it as `with self._connect() as conn` for one transaction"""
+        conn = getattr(self.local, "conn", None)
+        if conn is None:
+            conn = self.local.conn = sqlite3.connect(self.path, timeout=10)
+        return conn
+
+    def get(self, key):
+        with self._connect() as conn:
+            row = conn.execute("SELECT value FROM state WHERE key = ? AND expires > ?", (key, time.time())).fetchone()
+            return row[0] if row else None
+
+    def set(self, key, value, ttl):
+        with self._connect() as conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO state (key, value, expires) VALUES (?, ?, ?)",
+                (key, value, time.time() + ttl),
+            )
+
+    def delete(self, key):
+        with self._connect() as conn:
+            conn.execute("DELETE FROM state WHERE key = ?", (key,))
+
+    def purge(self):
+        with self._connect() as conn:
+            return conn.execute("DELETE FROM state WHERE expires <= ?", (time.time(),)).rowcount
+
+class RedisStore:
+    """Store on Redis, or on anything with the same get/set(ex=)/delete calls"""
+
+    shared = True
+
+    def __init__(self, client):
+        self.client = client
+
+    @classmethod
+    def from_url(cls, url):
+        import redis  # only needed for this backend
+        return cls(redis.Redis.from_url(url))
+
+    def get(self, key):
+        value = self.client.get(key)
+        return value.decode() if isinstance(value, bytes) else value
+
+    def set(self, key, value, ttl):
+        self.client.set(key, value, ex=max(1, int(ttl)))
+
+    def delete(self, key):
+        self.client.delete(key)
+
+    def purge(self):
+        # Redis expires keys on its own
+        return 0
+
+class DictRedis:
+    """Dict-backed stand-in for the redis.Redis calls RedisStore makes, so that backend runs without a server"""
+
+    def __init__(self):
+        self.data = {}  # key -> (value as bytes, expires or None)
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.data.get(key)
+            if entry and entry[1] is not None and entry[1] <= time.time():
+                del self.data[key]
+                entry = None
+            return entry[0] if entry else None
+
+    def set(self, key, value, ex=None):
+        # Like redis-py: values come back as bytes
+        if not isinstance(value, bytes):
+            value = str(value).encode()
+        with self.lock:
+            self.data[key] = (value, time.time() + ex if ex else None)
+        return True
+
+    def delete(self, key):
+        with self.lock:
+            return int(self.data.pop(key, None) is not None)
+
+def open_store(url=STATE_STORE):
+    if url == "memory":
+        return MemoryStore()
+    if url.startswith("sqlite:///"):
+        return SqliteStore(url[len("sqlite:///"):])
+    if url == "dictredis://":
+        return RedisStore(DictRedis())
+    if url.startswith(("redis://", "rediss://", "unix://")):
+        return RedisStore.from_url(url)
+    raise ValueError(f"Unknown STATE_STORE: {url}")
+
+# Session fields -> (key in the stored record, accepted types)
+SESSION_FIELDS = {
+    "step": ("s", str),
+    "mode": ("m", str),
+    "base_url": ("b", str),
+    "manga_name": ("n", str),
+    "total_chapters": ("t", (int, float)),
+    "chapters": ("c", list),
+    "awal": ("a", (int, float)),
+    "akhir": ("z", (int, float)),
+    "format": ("f", str),
+    "series_info": ("i", dict),
+}
+_FIELD_NAMES = {short: name for name, (short, _) in SESSION_FIELDS.items()}
+
+def encode_session(state):
+    """A session dict as compact JSON with one-letter keys; unknown fields or wrong types raise ValueError"""
+    record = {}
+    for name, value in state.items():
+        if name not in SESSION_FIELDS:
+            raise ValueError(f"Unknown session field: {name}")
+        short, kind = SESSION_FIELDS[name]
+        if value is None:
+            continue
+        if isinstance(value, tuple):
+            value = list(value)
+        if not isinstance(value, kind) or isinstance(value, bool):
+            raise ValueError(f"Session field {name} must be {kind}, got {type(value).__name__}")
+        record[short] = value
+    return json.dumps(record, separators=(",", ":"), ensure_ascii=False)
+
+def decode_session(data):
+    record = json.loads(data)
+    state = {_FIELD_NAMES[short]: value for short, value in record.items() if short in _FIELD_NAMES}
+    if "chapters" in state:
+        state["chapters"] = [tuple(chapter) for chapter in state["chapters"]]
+    return state
+
+class Sessions:
+    """Conversation state per chat. Reads return a copy; changes must be written back with put() or update()"""
+
+    def __init__(self, store, ttl=SESSION_TTL):
+        self.store = store
+        self.ttl = ttl
+
+    def _key(self, chat_id):
+        return f"{STATE_PREFIX}session:{chat_id}"
+
+    def get(self, chat_id):
+        data = self.store.get(self._key(chat_id))
+        return decode_session(data) if data else None
+
+    def put(self, chat_id, state):
+        self.store.set(self._key(chat_id), encode_session(state), self.ttl)
+
+    def update(self, chat_id, **fields):
+        """Merge fields into the chat's session and return it; None when the chat has no session"""
+        state = self.get(chat_id)
+        if state is None:
+            return None
+        state.update(fields)
+        self.put(chat_id, state)
+        return state
+
+    def pop(self, chat_id, default=None):
+        state = self.get(chat_id)
+        if state is None:
+            return default
+        self.store.delete(self._key(chat_id))
+        return state
+
+    def __contains__(self, chat_id):
+        return self.get(chat_id) is not None
+
+class Flags:
+    """Per-chat on/off switches with a dict-like get/set/pop, usable as the user_cancel mapping
+
+    A set flag reads back as the time it was set, so callers can tell which
+    jobs were queued before it.
+    """
+
+    def __init__(self, store, name, ttl=FLAG_TTL):
+        self.store = store
+        self.name = name
+        self.ttl = ttl
+        self.cache = OrderedDict()  # chat_id -> (value, read at), oldest first; only used for shared stores
+        self.lock = threading.Lock()
+
+    def _key(self, chat_id):
+        return f"{STATE_PREFIX}{self.name}:{chat_id}"
+
+    def get(self, chat_id, default=None):
+        if self.store.shared:
+            with self.lock:
+                cached = self.cache.get(chat_id)
+            if cached and time.monotonic() - cached[1] < FLAG_CACHE_SECONDS:
+                return cached[0] if cached[0] is not None else default
+        data = self.store.get(self._key(chat_id))
+        value = float(data) if data else None
+        if self.store.shared:
+            self._remember(chat_id, value)
+        return value if value is not None else default
+
+    def __setitem__(self, chat_id, on):
+        value = time.time() if on else None
+        if on:
+            self.store.set(self._key(chat_id), repr(value), self.ttl)
+        else:
+            self.store.delete(self._key(chat_id))
+        if self.store.shared:
+            self._remember(chat_id, value)
+
+    def _remember(self, chat_id, value):
+        now = time.monotonic()
+        with self.lock:
+            self.cache[chat_id] = (value, now)
+            self.cache.move_to_end(chat_id)
+            # Entries that can no longer be served are dropped from the old end
+            while self.cache and now - next(iter(self.cache.values()))[1] >= FLAG_CACHE_SECONDS:
+                self.cache.popitem(last=False)
+
+    def pop(self, chat_id, default=None):
+        value = self.get(chat_id, default)
+        self[chat_id] = False
+        return value
@@ -0,0 +1,158 @@
+import time
+
+import pytest
+
+import state_store
+from state_store import DictRedis, Flags, MemoryStore, RedisStore, Sessions, SqliteStore
+
+@pytest.fixture
+def clock(monkeypatch):
+    """Frozen time.time() that tests move forward with clock.advance(seconds)"""
+    class Clock:
+        now = 1_000_000.0
+
+        def advance(self, seconds):
+            self.now += seconds
+
+    clock = Clock()
+    monkeypatch.setattr(time, "time", lambda: clock.now)
+    return clock
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return MemoryStore()
+    if request.param == "sqlite":
+        return SqliteStore(str(tmp_path / "state" / "state.db"))
+    return RedisStore(DictRedis())
+
+def test_set_get_delete(store):
+    assert store.get("k") is None
+    store.set("k", "v", 60)
+    assert store.get("k") == "v"
+    store.set("k", "w", 60)
+    assert store.get("k") == "w"
+    store.delete("k")
+    assert store.get("k") is None
+    store.delete("missing")
+
+def test_keys_expire(store, clock):
+    store.set("short", "a", 10)
+    store.set("long", "b", 100)
+    clock.advance(11)
+    assert store.get("short") is None
+    assert store.get("long") == "b"
+    clock.advance(100)
+    assert store.get("long") is None
+
+def test_rewritten_key_keeps_its_new_ttl(store, clock):
+    store.set("k", "old", 10)
+    store.set("k", "new", 100)
+    clock.advance(11)
+    assert store.get("k") == "new"
+
+def test_purge_counts_expired_keys(clock):
+    store = MemoryStore()
+    for i in range(3):
+        store.set(f"k{i}", "v", 10)
+    store.set("kept", "v", 100)
+    clock.advance(11)
+    assert store.purge() == 3
+    assert store.purge() == 0
+    assert store.get("kept") == "v"
+
+def test_sqlite_purge_and_sharing(tmp_path, clock):
+    path = str(tmp_path / "state.db")
+    store = SqliteStore(path)
+    store.set("gone", "v", 10)
+    store.set("kept", "v", 100)
+    clock.advance(11)
+    assert store.purge() == 1
+    # A second store on the same file, as another process would open it, sees the same data
+    assert SqliteStore(path).get("kept") == "v"
+
+def test_dict_redis_returns_bytes():
+    client = DictRedis()
+    client.set("k", "v", ex=5)
+    assert client.get("k") == b"v"
+    assert client.delete("k") == 1
+    assert client.delete("k") == 0
+
+def test_open_store():
+    assert isinstance(state_store.open_store("memory"), MemoryStore)
+    assert isinstance(state_store.open_store("dictredis://").client, DictRedis)
+    with pytest.raises(ValueError):
+        state_store.open_store("nosuch://")
+
+def test_session_roundtrip():
+    state = {
+        "step": "awal",
+        "mode": "big",
+        "base_url": "https://komiku.org/one-piece-chapter-",
+        "manga_name": "one-piece",
+        "total_chapters": 1100,
+        "chapters": [(1, "https://komiku.org/one-piece-chapter-1/"), (1.5, "https://komiku.org/one-piece-chapter-1-5/")],
+        "awal": 1,
+        "akhir": 1.5,
+        "format": "pdf",
+        "series_info": {"title": "One Piece", "genres": ["Action"]},
+    }
+    data = state_store.encode_session(state)
+    assert state_store.decode_session(data) == state
+    # One-letter keys keep records small
+    assert '"step"' not in data
+
+def test_session_skips_none_fields():
+    assert state_store.decode_session(state_store.encode_session({"step": "awal", "mode": None})) == {"step": "awal"}
+
+@pytest.mark.parametrize("state", [
+    {"unknown": 1},
+    {"awal": "1"},
+    {"awal": True},
+    {"chapters": "1-5"},
+])
+def test_session_rejects_bad_fields(state):
+    with pytest.raises(ValueError):
+        state_store.encode_session(state)
+
+def test_decode_ignores_unknown_keys():
+    assert state_store.decode_session('{"s":"awal","?":1}') == {"step": "awal"}
+
+def test_sessions(store):
+    sessions = Sessions(store)
+    assert sessions.get(1) is None
+    assert sessions.update(1, step="akhir") is None
+    sessions.put(1, {"step": "awal"})
+    assert 1 in sessions
+    assert sessions.update(1, awal=3) == {"step": "awal", "awal": 3}
+    assert sessions.pop(1) == {"step": "awal", "awal": 3}
+    assert 1 not in sessions
+    assert sessions.pop(1, "none") == "none"
+
+def test_flags(store, clock):
+    flags = Flags(store, "cancel")
+    assert flags.get(1) is None
+    flags[1] = True
+    assert flags.get(1) == clock.now
+    assert flags.pop(1) == clock.now
+    assert flags.get(1, False) is False
+
+def test_flags_seen_by_other_processes(tmp_path, clock, monkeypatch):
+    monkeypatch.setattr(state_store, "FLAG_CACHE_SECONDS", 0)
+    path = str(tmp_path / "state.db")
+    mine, theirs = Flags(SqliteStore(path), "cancel"), Flags(SqliteStore(path), "cancel")
+    assert theirs.get(7) is None
+    mine[7] = True
+    assert theirs.get(7) == clock.now
+
+def test_flag_cache_drops_stale_entries(monkeypatch):
+    monkeypatch.setattr(state_store, "FLAG_CACHE_SECONDS", 60)
+    flags = Flags(RedisStore(DictRedis()), "cancel")
+    now = [0.0]
+    monkeypatch.setattr(time, "monotonic", lambda: now[0])
+    for chat_id in range(100):
+        flags.get(chat_id)
+    assert len(flags.cache) == 100
+    now[0] = 61
+    flags.get("new")
+    assert list(flags.cache) == ["new"]
@@ -0,0 +1,321 @@
+# uploader.py
+# Document uploads to the Telegram Bot API.
+#
+# Files are sent as a multipart body read from disk while the request goes
+# out, so a 50 MB PDF is never held in memory. Telegram's 429 answers are
+# retried after the retry_after they carry, and so are connections that were
+# never opened; anything else may already have been delivered and is not
+# resent. UploadQueue runs uploads for one job in the background, so the next
+# chapter downloads and builds while the previous one uploads. Telegram orders
+# messages by when each request arrives, so by default a chat's uploads go out
+# one at a time, in order; re-sends of cached documents and notices go through
+# the same queue so they can't overtake them. Documents that are waiting
+# together go out as a single sendMediaGroup request, and every file is
+# deleted as soon as its upload is over.
+import json
+import os
+import random
+import threading
+import time
+import uuid
+from collections import deque
+from io import BytesIO
+import requests
+from telebot import apihelper
+from urllib3.exceptions import ConnectTimeoutError
+import metrics
+
+# Telegram groups 2-10 documents per message; large files go alone
+# Uploads one chat's job runs at the same time. Above 1 a small document can
+# finish before a bigger one submitted earlier, and then reaches the chat first
+UPLOADS_PER_CHAT = max(1, int(os.getenv("UPLOADS_PER_CHAT", "1")))
+MEDIA_GROUP_SIZE = max(1, min(10, int(os.getenv("MEDIA_GROUP_SIZE", "10"))))
+MEDIA_GROUP_MAX_BYTES = int(float(os.getenv("MEDIA_GROUP_MAX_MB", "50")) * 1024 * 1024)
+UPLOAD_RETRIES = int(os.getenv("UPLOAD_RETRIES", "5"))
+UPLOAD_CONNECT_TIMEOUT = float(os.getenv("UPLOAD_CONNECT_TIMEOUT", "10"))
+UPLOAD_READ_TIMEOUT = float(os.getenv("UPLOAD_READ_TIMEOUT", "600"))
+UPLOAD_CHUNK_SIZE = 256 * 1024
+
+_session = requests.Session()
+
+class TelegramError(Exception):
+    def __init__(self, method, code, description):
+        super().__init__(f"{method} failed ({code}): {description}")
+        self.code = code
+
+class MultipartBody:
+    """multipart/form-data body that streams its files from disk; requests sends it with a Content-Length"""
+
+    def __init__(self, fields, files):
+        self.boundary = uuid.uuid4().hex
+        self.parts = deque()
+        for name, value in fields.items():
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"\r\n\r\n{value}\r\n'.encode()
+            )
+        for name, path in files:
+            # HTML5-style filename: UTF-8 with quotes and newlines escaped
+            filename = os.path.basename(path).replace('"', "%22").replace("\r", "%0D").replace("\n", "%0A")
+            self.parts.append(
+                f'--{self.boundary}\r\nContent-Disposition: form-data; name="{name}"; filename="{filename}"\r\n'
+                f"Content-Type: application/octet-stream\r\n\r\n".encode()
+            )
+            self.parts.append(path)
+            self.parts.append(b"\r\n")
+        self.parts.append(f"--{self.boundary}--\r\n".encode())
+        self.length = sum(os.path.getsize(part) if isinstance(part, str) else len(part) for part in self.parts)
+        self.current = None
+
+    @property
+    def content_type(self):
+        return f"multipart/form-data; boundary={self.boundary}"
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.length
+        out = bytearray()
+        while len(out) < size:
+            if self.current is None:
+                if not self.parts:
+                    break
+                part = self.parts.popleft()
+                self.current = open(part, "rb") if isinstance(part, str) else BytesIO(part)
+            data = self.current.read(min(size - len(out), UPLOAD_CHUNK_SIZE))
+            if data:
+                out += data
+            else:
+                self.current.close()
+                self.current = None
+        return bytes(out)
+
+    def close(self):
+        if self.current is not None:
+            self.current.close()
+            self.current = None
+
+def api_url(token, method):
+    # Follows TELEGRAM_API_URL (see main.py) the same way telebot does
+    return (apihelper.API_URL or "https://api.telegram.org/bot{0}/{1}").format(token, method)
+
+def _not_sent(error):
+    """True when the connection was never opened, so Telegram can't have received the request"""
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], "reason", None) if error.args else None
+    # Also covers NewConnectionError (refused, DNS failure), a subclass
+    return isinstance(reason, ConnectTimeoutError)
+
+def call(token, method, fields, files=()):
+    """POST a Bot API method with files streamed from disk; retries 429 (after retry_after) and failed connects
+
+    5xx answers and connections dropped mid-request are not retried: Telegram
+    may have sent the message already, and a retry would send it twice.
+    """
+    for attempt in range(UPLOAD_RETRIES + 1):
+        body = MultipartBody(fields, files)
+        try:
+            resp = _session.post(
+                api_url(token, method),
+                data=body,
+                headers={"Content-Type": body.content_type},
+                timeout=(UPLOAD_CONNECT_TIMEOUT, UPLOAD_READ_TIMEOUT),
+            )
+        except requests.exceptions.ConnectionError as e:
+            if attempt >= UPLOAD_RETRIES or not _not_sent(e):
+                raise
+            time.sleep(min(30, 2 ** attempt) + random.uniform(0, 1))
+            continue
+        finally:
+            body.close()
+        try:
+            data = resp.json()
+        except ValueError:
+            data = {"ok": False, "description": resp.text[:200]}
+        if data.get("ok"):
+            return data["result"]
+        retry_after = (data.get("parameters") or {}).get("retry_after")
+        if attempt < UPLOAD_RETRIES and resp.status_code == 429:
+            wait = retry_after if retry_after else min(30, 2 ** attempt) + random.uniform(0, 1)
+            print(f"⏳ Telegram {method} {resp.status_code}, retry in {wait:.0f}s")
+            time.sleep(wait)
+            continue
+        raise TelegramError(method, resp.status_code, data.get("description"))
+
+def send_documents(token, chat_id, files):
+    """Upload [(path, caption)] as one message (one file) or one album (2-10 files); returns their file_ids"""
+    with metrics.span("telegram_upload"):
+        if len(files) == 1:
+            path, caption = files[0]
+            sent = [call(token, "sendDocument", {"chat_id": chat_id, "caption": caption}, [("document", path)])]
+        else:
+            media = [
+                {"type": "document", "media": f"attach://file{i}", "caption": caption}
+                for i, (_, caption) in enumerate(files)
+            ]
+            attachments = [(f"file{i}", path) for i, (path, _) in enumerate(files)]
+            sent = call(token, "sendMediaGroup", {"chat_id": chat_id, "media": json.dumps(media)}, attachments)
+    metrics.uploaded_bytes.inc(sum(os.path.getsize(path) for path, _ in files))
+    for path, _ in files:
+        print(f"✅ File sent: {path}")
+    return [(message.get("document") or {}).get("file_id") for message in sent]
+
+class Document:
+    """One delivered document: its file(s) in part order, their captions and the result-cache key
+
+    With file_ids (and no paths) it is a document uploaded before, sent again
+    by those file_ids. done is set once the queue has finished with it.
+    """
+
+    def __init__(self, paths, captions, cache_key=None, name=None, file_ids=None):
+        self.paths = list(paths)
+        self.captions = list(captions)
+        self.cache_key = cache_key
+        self.name = name or os.path.basename(self.paths[0])
+        self.cached = file_ids is not None
+        self.file_ids = list(file_ids) if self.cached else [None] * len(self.paths)
+        self.error = None
+        self.done = threading.Event()
+
+class Notice:
+    """A text message for the chat, kept in order with the documents around it"""
+
+    paths = ()
+
+    def __init__(self, text):
+        self.text = text
+        self.error = None
+        self.done = threading.Event()
+
+def _remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+def upload(token, chat_id, doc):
+    """Send a document's files in order, in as few requests as the album limits allow; files are deleted afterwards"""
+    try:
+        batch = []
+        for index, path in enumerate(doc.paths):
+            batch.append(index)
+            size = sum(os.path.getsize(doc.paths[i]) for i in batch)
+            if len(batch) > 1 and (len(batch) > MEDIA_GROUP_SIZE or size > MEDIA_GROUP_MAX_BYTES):
+                batch.pop()
+                _send_batch(token, chat_id, doc, batch)
+                batch = [index]
+        _send_batch(token, chat_id, doc, batch)
+    finally:
+        for path in doc.paths:
+            _remove(path)
+    return doc.file_ids
+
+def resend(token, chat_id, doc):
+    """Send a cached document again, one message per file_id"""
+    for file_id, caption in zip(doc.file_ids, doc.captions):
+        call(token, "sendDocument", {"chat_id": chat_id, "document": file_id, "caption": caption})
+
+def _send_batch(token, chat_id, doc, batch):
+    file_ids = send_documents(token, chat_id, [(doc.paths[i], doc.captions[i]) for i in batch])
+    for i, file_id in zip(batch, file_ids):
+        doc.file_ids[i] = file_id
+
+def _packable(doc):
+    return isinstance(doc, Document) and not doc.cached
+
+class UploadQueue:
+    """Background uploads for one job
+
+    Documents, cached re-sends and Notices are sent by up to `workers`
+    threads; with one (the default) they reach the chat in the order they
+    were submitted. Files of waiting documents are packed into albums (whole
+    documents only, so each one's parts stay together and in order).
+    on_done(doc) / on_failed(doc, error) run on the upload thread once a
+    document is finished.
+    """
+
+    def __init__(self, token, chat_id, on_done=None, on_failed=None, cancelled=lambda: False, workers=UPLOADS_PER_CHAT):
+        self.token = token
+        self.chat_id = chat_id
+        self.on_done = on_done
+        self.on_failed = on_failed
+        self.cancelled = cancelled
+        self.cond = threading.Condition()
+        self.waiting = deque()
+        self.closed = False
+        self.threads = [threading.Thread(target=self._worker, daemon=True, name=f"upload-{chat_id}-{i}") for i in range(max(1, workers))]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, doc):
+        with self.cond:
+            self.waiting.append(doc)
+            self.cond.notify()
+
+    def _take(self):
+        """The next album's worth of waiting documents (re-sends and notices go alone)"""
+        docs = [self.waiting.popleft()]
+        if not _packable(docs[0]):
+            return docs
+        files = len(docs[0].paths)
+        size = sum(os.path.getsize(path) for path in docs[0].paths)
+        while self.waiting and _packable(self.waiting[0]):
+            nxt = self.waiting[0]
+            nxt_size = sum(os.path.getsize(path) for path in nxt.paths)
+            if files + len(nxt.paths) > MEDIA_GROUP_SIZE or size + nxt_size > MEDIA_GROUP_MAX_BYTES:
+                break
+            docs.append(self.waiting.popleft())
+            files += len(nxt.paths)
+            size += nxt_size
+        return docs
+
+    def _worker(self):
+        while True:
+            with self.cond:
+                while not self.waiting and not self.closed:
+                    self.cond.wait()
+                if not self.waiting:
+                    return
+                docs = self._take()
+            self._send(docs)
+
+    def _send(self, docs):
+        try:
+            if self.cancelled():
+                return
+            if isinstance(docs[0], Notice):
+                call(self.token, "sendMessage", {"chat_id": self.chat_id, "text": docs[0].text})
+                return
+            if docs[0].cached:
+                resend(self.token, self.chat_id, docs[0])
+            elif len(docs) == 1:
+                upload(self.token, self.chat_id, docs[0])
+            else:
+                files = [(path, caption) for doc in docs for path, caption in zip(doc.paths, doc.captions)]
+                file_ids = send_documents(self.token, self.chat_id, files)
+                for doc in docs:
+                    doc.file_ids, file_ids = file_ids[:len(doc.paths)], file_ids[len(doc.paths):]
+            for doc in docs:
+                if self.on_done:
+                    self.on_done(doc)
+        except Exception as e:
+            print(f"❌ Upload error: {e}")
+            for doc in docs:
+                doc.error = e
+                if self.on_failed and not isinstance(doc, Notice):
+                    self.on_failed(doc, e)
+        finally:
+            for doc in docs:
+                for path in doc.paths:
+                    _remove(path)
+                doc.done.set()
+
+    def close(self):
+        """Wait until every submitted document has been uploaded (or dropped on cancel)"""
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+        for thread in self.threads:
+            thread.join()